@@ -6,27 +6,144 @@ import time
 import requests
 import csv
 import io
+import hashlib
 import os
+import sys
+import queue
+import asyncio
+import atexit
+import bisect
+import heapq
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import deque
+from contextlib import contextmanager
+from array import array
 from datetime import datetime
+from urllib.parse import parse_qs
 from flask import Flask, render_template_string, jsonify, request, Response
 
+try:
+    import orjson   # opsional: parse payload MQTT lebih cepat
+except ImportError:
+    orjson = None
+
 # ================== KONFIGURASI ==================
 BROKER = "103.217.145.168"
 PORT = 1883
 TOPIC = "data/sctkiotserver/groupsctkiotserver/123"
 
-WEB_APP_URL = "https://script.google.com/macros/s/AKfycbzWJVmsuj6p0-JKzksnPcdRkfH0NKa9n0iI_HP2OBaVHbxNQqYaSDGkzbdSraE0sFg-/exec"
+# ====== MULTI SITE ======
+# 1 proses melayani banyak site; data tanpa site (DB lama, QC, jadwal) milik DEFAULT_SITE
+DEFAULT_SITE = os.environ.get("DEFAULT_SITE", "WTP3")
+QC_SITE = DEFAULT_SITE   # sheet QC = lab site ini
+# (filter topic, site); filter boleh wildcard +/#, site "$N" = segmen topic ke-N (0-based)
+# override env: MQTT_TOPICS="plant/+/telemetry=$1,data/x/y=WTP1"
+MQTT_TOPICS = [(TOPIC, DEFAULT_SITE), (TOPIC + "/#", DEFAULT_SITE)]
+if os.environ.get("MQTT_TOPICS"):
+    MQTT_TOPICS = [
+        (t.split("=", 1)[0].strip(), t.split("=", 1)[1].strip() if "=" in t else DEFAULT_SITE)
+        for t in os.environ["MQTT_TOPICS"].split(",") if t.strip()
+    ]
+
+# bisa di-override env WEB_APP_URL (mis. server lokal pengganti untuk test)
+WEB_APP_URL = os.environ.get("WEB_APP_URL", "https://script.google.com/macros/s/AKfycbzWJVmsuj6p0-JKzksnPcdRkfH0NKa9n0iI_HP2OBaVHbxNQqYaSDGkzbdSraE0sFg-/exec")
 SEND_INTERVAL = 60  # detik
 
+# ====== Pipeline MQTT: callback paho hanya antre, worker yang memproses ======
+MQTT_WORKERS = int(os.environ.get("MQTT_WORKERS", "2"))   # 1 topic selalu ke worker yang sama (urutan terjaga)
+MQTT_WORKER_QUEUE_MAX = 2000   # pesan antre per worker; penuh -> pesan dibuang + dihitung
+
+# ====== Timestamp sampel: waktu device kalau ada, selain itu waktu terima (presisi ms) ======
+MQTT_TS_KEYS = ["ts", "timestamp", "time", "datetime"]   # nama field (huruf bebas): data dulu, lalu envelope luar
+MQTT_TS_MAX_FUTURE = 300       # detik; ts device lebih maju dari waktu terima -> jam device salah, pakai waktu terima
+MQTT_TS_MAX_AGE = 7 * 86400    # detik; replay lebih tua dari ini juga dianggap jam salah
+
+# ====== Forward ke WEB_APP_URL (thread terpisah, bukan di thread MQTT) ======
+WEBHOOK_QUEUE_MAX = 1000        # sampel antre di memori; penuh -> langsung ke spool
+WEBHOOK_TIMEOUT = 10            # detik per POST
+WEBHOOK_BATCH_MAX = 100         # sampel per POST saat mengejar spool
+WEBHOOK_BACKOFF_MIN = 2         # detik, dobel tiap gagal
+WEBHOOK_BACKOFF_MAX = 300       # detik
+WEBHOOK_SPOOL_FILE = "webhook_spool.jsonl"
+WEBHOOK_SPOOL_MAX = 50000       # baris; lebih dari ini sampel tertua dibuang
+
 # ====== QC CSV (Google Sheets publish CSV) ======
-QC_CSV_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vSMKrU7GU9pisN4ihKgSqyC1bDuT1ia6kp-vKWrdUhvaPyX95ZqOBOFy8iBCpQieizqTBJ3R4wNmRII/pub?gid=2046456175&single=true&output=csv"
+# bisa di-override env QC_CSV_URL (mis. server lokal pengganti untuk test)
+QC_CSV_URL = os.environ.get("QC_CSV_URL", "https://docs.google.com/spreadsheets/d/e/2PACX-1vSMKrU7GU9pisN4ihKgSqyC1bDuT1ia6kp-vKWrdUhvaPyX95ZqOBOFy8iBCpQieizqTBJ3R4wNmRII/pub?gid=2046456175&single=true&output=csv")
 QC_PULL_INTERVAL = 20  # detik
+QC_INCREMENTAL = True  # ETag/Last-Modified + hash body + parse hanya baris yang ditambahkan
+QC_CACHE_BUST_EVERY = 300  # detik; sesekali pull dengan ?_=<epoch> (cache publish Google bisa basi). 0 = tidak pernah.
+                           # pull lain pakai URL tetap supaya ETag/Last-Modified bisa dijawab 304
+QC_DB_WARM_DAYS = 400  # baris QC dari DB yang dimuat ke memori saat start (sebelum pull pertama)
+QC_LAST_CACHE_N = 50   # sampel non-null terakhir per param yang disimpan untuk /api/qc/last
 
 # ====== JADWAL (JSON lokal) ======
 # >>>>>>>>>>>> UDAH DIUBAH: pakai 1 file setahun <<<<<<<<<<<<
 # Taruh file JSON ini di folder yang sama dengan file python ini
 SCHEDULE_JSON_FILE = "jadwal_2026.json"
-SCHEDULE_RELOAD_INTERVAL = 10  # detik cek perubahan file
+SCHEDULE_RELOAD_INTERVAL = 10  # detik cek perubahan file (fallback polling)
+SCHEDULE_WATCH_INOTIFY = True  # Linux: reload begitu file berubah, idle tanpa polling
+SCHEDULE_WATCH_DEBOUNCE = 0.3  # detik tunggu event reda sebelum reload
+SCHEDULE_WATCH_RETRY = 60      # detik; inotify gagal/error -> polling, lalu coba watch lagi tiap ini
+SCHEDULE_LOAD_CHUNK = 65536    # byte per baca saat parse JSON jadwal bertahap
+SCHEDULE_RESP_CACHE_MAX = 800  # jumlah tanggal yang response JSON-nya di-cache
+
+# ====== INGEST DB (writer thread) ======
+INGEST_QUEUE_MAX = 5000        # maksimum sampel yang antri ke writer
+INGEST_BATCH_ROWS = 500        # commit kalau baris pending sudah sebanyak ini
+INGEST_FLUSH_INTERVAL = 1.0    # detik, commit paling lambat setelah sampel pertama masuk
+INGEST_PUT_TIMEOUT = 0.2       # detik nunggu kalau antrian penuh, habis itu sampel di-drop
+
+# ====== KOMPRESI INGEST (deadband / swinging door per key) ======
+# key -> (mode, toleransi absolut, toleransi % dari nilai terakhir yang disimpan); dipakai yang lebih besar
+#   "deadband" : ditulis kalau berubah > toleransi, history direkonstruksi step-hold
+#   "swing"    : swinging door, hanya titik belok yang ditulis, history direkonstruksi interpolasi linear
+# key yang tidak ada di sini tetap ditulis tiap sampel; kosong = kompresi mati (seperti dulu)
+# contoh: {"LVL_RES_WTP3": ("deadband", 0.01, 0), "PRESSURE_DST": ("deadband", 0, 0.5), "FLOW_WTP3": ("swing", 0.5, 0)}
+COMPRESS_KEYS = {}
+COMPRESS_HEARTBEAT = 300       # detik; key terkompresi tetap ditulis minimal sekali per ini (celah > 2x ini di history = data putus)
+
+# ====== KONEKSI SQLITE (pool) ======
+DB_POOL_SIZE = 8                    # koneksi baca/tulis bersama (writer ingest punya koneksi sendiri)
+DB_BUSY_TIMEOUT = 10                # detik
+DB_MMAP_SIZE = 256 * 1024 * 1024    # bytes
+DB_CACHE_KB = 16384                 # page cache per koneksi
+DB_STATEMENT_CACHE = 256            # prepared statement yang di-cache per koneksi
+
+# ====== STORAGE MEASUREMENTS ======
+# "wide"   : 1 baris per timestamp, 1 kolom REAL per key (tabel measurements_wide)
+# "narrow" : format lama measurements(ts, key, value), 1 baris per key
+DB_STORAGE_MODE = os.environ.get("DB_STORAGE_MODE", "wide")
+MIGRATE_BATCH_ROWS = 20000     # baris narrow per transaksi saat migrasi ke wide
+MIGRATE_PAUSE = 0.05           # detik jeda antar batch migrasi (biar writer tetap lancar)
+
+# ====== ROLLUP (pre-agregasi untuk /api/history) ======
+ROLLUP_RESOLUTIONS = [60, 300, 3600]   # detik, urut naik, tiap resolusi kelipatan resolusi sebelumnya
+ROLLUP_BACKFILL_CHUNK = 6 * 3600       # detik data lama yang di-rollup per langkah backfill
+WRITER_IDLE_TICK = 1.0                 # detik, writer cek kerjaan maintenance kalau antrian kosong
+
+# ====== RETENTION history.db ======
+RETENTION_RAW_DAYS = 30                                   # data raw (per sampel), 0 = simpan selamanya
+RETENTION_ROLLUP_DAYS = {60: 90, 300: 365, 3600: 0}       # per resolusi rollup, 0 = simpan selamanya
+RETENTION_INTERVAL = 900                                  # detik antar siklus retention
+RETENTION_BATCH_ROWS = 2000                               # baris per DELETE (transaksi pendek)
+RETENTION_BATCH_PAUSE = 0.05                              # detik jeda antar batch DELETE
+RETENTION_VACUUM_PAGES = 2000                             # halaman dikembalikan ke OS per siklus
+
+# ====== HOT CACHE (ring buffer history terbaru di memori) ======
+HOT_CACHE_SECONDS = 2 * 3600     # jendela yang dijawab dari memori
+HOT_CACHE_CAPACITY = 8192        # sampel per key (cukup untuk ~1 sampel/detik selama 2 jam)
+
+# ====== SSE (/events) ======
+SSE_CLIENT_QUEUE = 16      # event per client yang boleh antri, lebih dari itu event lama dibuang
+SSE_KEEPALIVE = 15         # detik, kirim komentar ping kalau tidak ada event
+SSE_MIN_INTERVAL = 1.0     # detik, event sejenis digabung (yang terbaru saja) kalau lebih rapat
+
+# ====== ASGI (python app.py asgi / uvicorn app:asgi_app) ======
+ASGI_EXECUTOR_WORKERS = 16   # thread untuk route Flask (DB/IO blocking) di mode ASGI
 
 # ====== MODEL RESERVOIR ======
 RES_MAX_M = 8.0
@@ -91,17 +208,33 @@ QC_ORDER = ["kekeruhan", "warna", "ph", "sisa_chlor"]
 
 # ================== GLOBAL ==================
 DB_PATH = "history.db"
-db_lock = threading.Lock()
 data_lock = threading.Lock()
 
 DEFAULT_DATA = {k: 0.0 for k in (NUMERIC_KEYS + DERIVED_KEYS)}
-latest_data = DEFAULT_DATA.copy()
-latest_ts_epoch = 0
-last_send_time = 0.0
+
+# state terbaru per site (dibuat saat site pertama kali muncul), dijaga data_lock
+class SiteState:
+    __slots__ = ("site", "data", "ts", "last_send", "comp")
+
+    def __init__(self, site):
+        self.site = site
+        self.data = DEFAULT_DATA.copy()
+        self.ts = 0
+        self.last_send = 0.0
+        self.comp = None   # SampleCompressor, dibuat saat dipakai (COMPRESS_KEYS tidak kosong)
+
+site_states = {DEFAULT_SITE: SiteState(DEFAULT_SITE)}
+
+def get_site_state(site):
+    # panggil dengan data_lock dipegang
+    st = site_states.get(site)
+    if st is None:
+        st = site_states[site] = SiteState(site)
+    return st
 
 # QC cache
 qc_lock = threading.Lock()
-qc_rows = []
+# qc_rows: QCSeries (kolumnar, terurut ts) -> didefinisikan di bagian QC helpers
 qc_latest = {p: {"ts": None, "dt": "-", "value": None} for p in QC_ORDER}
 qc_last_update_dt = "-"
 qc_last_update_chlor_dt = "-"
@@ -111,42 +244,1563 @@ qc_status = {
     "last_error": None,
     "row_count": 0,
     "headers": [],
+    "last_pull_mode": "-",   # full / delta / not_modified / unchanged
+    "last_bytes": 0,
+    "last_parsed_rows": 0,
 }
 
 # Jadwal cache
 schedule_lock = threading.Lock()
-schedule_rows = []         # list of dict
+schedule_rows = []         # list of ScheduleRow
+schedule_index = {}        # "YYYY-MM-DD" -> ({lokasi: operator list}, lab list), dibangun saat load
 schedule_last_loaded = "-" # dt string
 schedule_last_error = None
 _schedule_mtime = None
+_schedule_resp_cache = {}  # (date, site) -> (etag, body bytes), dikosongkan tiap reload
 
 # ================== DB ==================
+# ====== Pool koneksi: pragma di-set sekali per koneksi, statement di-cache ======
+_db_pool = queue.LifoQueue()
+_db_pool_lock = threading.Lock()
+_db_pool_open = 0
+
+def _open_conn():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)};")
+    conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_KB)};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    return conn
+
+@contextmanager
+def db_conn():
+    global _db_pool_open
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = None
+        with _db_pool_lock:
+            if _db_pool_open < DB_POOL_SIZE:
+                _db_pool_open += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                conn = _open_conn()
+            except Exception:
+                with _db_pool_lock:
+                    _db_pool_open -= 1
+                raise
+        else:
+            conn = _db_pool.get(timeout=DB_BUSY_TIMEOUT)
+
+    try:
+        yield conn
+    finally:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            _db_pool.put(conn)
+        except sqlite3.Error:
+            # koneksi rusak: buang, slot dipakai koneksi baru nanti
+            with _db_pool_lock:
+                _db_pool_open -= 1
+
+def db_pool_stats():
+    with _db_pool_lock:
+        return {"size": DB_POOL_SIZE, "open": _db_pool_open, "idle": _db_pool.qsize()}
+
+WIDE_KEYS = NUMERIC_KEYS + DERIVED_KEYS
+_narrow_pending = False  # masih ada data di tabel narrow yang belum dimigrasi ke wide
+
+def _col(key):
+    return '"' + key + '"'
+
+def _table_exists(cur, name):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return cur.fetchone() is not None
+
+def _has_column(cur, table, col):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r[1] == col for r in cur.fetchall())
+
+def _sql_str(v):
+    return "'" + str(v).replace("'", "''") + "'"
+
+def _upgrade_add_site(cur, table, create_sql, cols):
+    # tabel lama tanpa kolom site (PK berubah -> harus dibangun ulang); isinya milik DEFAULT_SITE
+    t0 = time.time()
+    cur.execute(f"ALTER TABLE {table} RENAME TO {table}_nosite")
+    cur.execute(create_sql)
+    cur.execute(f"INSERT INTO {table}(site, {cols}) SELECT ?, {cols} FROM {table}_nosite", (DEFAULT_SITE,))
+    n = cur.rowcount
+    cur.execute(f"DROP TABLE {table}_nosite")
+    print(f"[DB] {table} di-upgrade ke multi-site: {n} baris -> site {DEFAULT_SITE} ({time.time() - t0:.1f} s)")
+
+def _wide_create_sql():
+    cols = ", ".join(f"{_col(k)} REAL" for k in WIDE_KEYS)
+    return f"""
+        CREATE TABLE IF NOT EXISTS measurements_wide (
+            site TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            {cols},
+            PRIMARY KEY (site, ts)
+        ) WITHOUT ROWID
+    """
+
+def _rollup_create_sql(res):
+    return f"""
+        CREATE TABLE IF NOT EXISTS rollup_{res} (
+            site TEXT NOT NULL,
+            key TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            cnt INTEGER NOT NULL,
+            vsum REAL NOT NULL,
+            vmin REAL NOT NULL,
+            vmax REAL NOT NULL,
+            PRIMARY KEY (site, key, bucket)
+        ) WITHOUT ROWID
+    """
+
 def init_db():
-    with sqlite3.connect(DB_PATH, timeout=10) as conn:
+    global _narrow_pending
+    with db_conn() as conn:
         cur = conn.cursor()
+        # hanya berlaku untuk file baru; file lama dikonversi sekali lewat vacuum_incremental()
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL;")
         cur.execute("PRAGMA journal_mode=WAL;")
+
+        # narrow lama tanpa site: kolom ber-default cukup ALTER (tanpa tulis ulang tabel)
+        if _table_exists(cur, "measurements") and not _has_column(cur, "measurements", "site"):
+            cur.execute(f"ALTER TABLE measurements ADD COLUMN site TEXT NOT NULL DEFAULT {_sql_str(DEFAULT_SITE)}")
+
+        if DB_STORAGE_MODE == "wide":
+            if _table_exists(cur, "measurements_wide"):
+                # key baru di NUMERIC_KEYS -> tambah kolom
+                cur.execute("PRAGMA table_info(measurements_wide)")
+                have = {r[1] for r in cur.fetchall()}
+                for k in WIDE_KEYS:
+                    if k not in have:
+                        cur.execute(f"ALTER TABLE measurements_wide ADD COLUMN {_col(k)} REAL")
+                if "site" not in have:
+                    cols = ", ".join(["ts"] + [_col(k) for k in WIDE_KEYS])
+                    _upgrade_add_site(cur, "measurements_wide", _wide_create_sql(), cols)
+            cur.execute(_wide_create_sql())
+            # retention & batas rollup scan per waktu lintas site
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_wide_ts ON measurements_wide(ts)")
+
+            _narrow_pending = False
+            if _table_exists(cur, "measurements"):
+                cur.execute("SELECT 1 FROM measurements LIMIT 1")
+                _narrow_pending = cur.fetchone() is not None
+        else:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS measurements (
+                    ts INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    site TEXT NOT NULL DEFAULT {_sql_str(DEFAULT_SITE)}
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_measurements_key_ts ON measurements(key, ts)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_measurements_site_key_ts ON measurements(site, key, ts)")
+
+        for res in ROLLUP_RESOLUTIONS:
+            if _table_exists(cur, f"rollup_{res}") and not _has_column(cur, f"rollup_{res}", "site"):
+                _upgrade_add_site(cur, f"rollup_{res}", _rollup_create_sql(res), "key, bucket, cnt, vsum, vmin, vmax")
+            cur.execute(_rollup_create_sql(res))
+        cur.execute("CREATE TABLE IF NOT EXISTS storage_meta (name TEXT PRIMARY KEY, value)")
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS measurements (
-                ts INTEGER NOT NULL,
-                key TEXT NOT NULL,
-                value REAL NOT NULL
+            CREATE TABLE IF NOT EXISTS qc_samples (
+                ts INTEGER PRIMARY KEY,
+                dt TEXT NOT NULL,
+                kekeruhan REAL,
+                warna REAL,
+                ph REAL,
+                sisa_chlor REAL
             )
         """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_measurements_key_ts ON measurements(key, ts)")
         conn.commit()
 
-def save_to_db(ts_epoch: int, data: dict):
-    with db_lock:
-        with sqlite3.connect(DB_PATH, timeout=10) as conn:
-            cur = conn.cursor()
-            rows = [(ts_epoch, k, float(v)) for k, v in data.items()]
-            cur.executemany("INSERT INTO measurements(ts, key, value) VALUES (?, ?, ?)", rows)
+        _warn_auto_vacuum(cur)
+
+def _warn_auto_vacuum(cur):
+    # konversi tidak pernah dilakukan server yang sedang jalan (VACUUM memegang lock tulis, ingest tertahan)
+    if _db_pages(cur, "auto_vacuum") != 2:
+        print("[DB] history.db masih auto_vacuum=none: retention tidak bisa mengecilkan file. "
+              "Konversi sekali (offline, DB terkunci selama VACUUM): python app.py vacuum")
+
+def vacuum_incremental():
+    # VACUUM penuh + auto_vacuum=INCREMENTAL, hanya dari perintah offline (vacuum / migrate-wide).
+    # File yang dibuat sebelum pragma itu ada tetap auto_vacuum=none dan incremental_vacuum
+    # di retention tidak berbuat apa-apa sampai dikonversi.
+    t0 = time.time()
+    with db_conn() as conn:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"[DB] VACUUM (auto_vacuum=incremental) selesai dalam {time.time() - t0:.1f} s")
+
+def db_sites(cur, table):
+    # daftar site distinct lewat skip-scan PK (site, ...) -> O(jumlah site), bukan O(baris)
+    cur.execute(f"""
+        WITH RECURSIVE s(site) AS (
+            SELECT MIN(site) FROM {table}
+            UNION ALL
+            SELECT (SELECT MIN(site) FROM {table} WHERE site > s.site) FROM s WHERE s.site IS NOT NULL
+        )
+        SELECT site FROM s WHERE site IS NOT NULL
+    """)
+    return [r[0] for r in cur.fetchall()]
+
+def migrate_narrow_to_wide(vacuum=False):
+    # online: per batch rowid, copy ke wide + hapus dari narrow dalam 1 transaksi,
+    # jadi pembaca (narrow+wide dalam 1 snapshot) tidak pernah lihat data dobel / hilang
+    global _narrow_pending
+    t0 = time.time()
+    moved = 0
+    with db_conn() as conn:
+        has_narrow = _table_exists(conn.cursor(), "measurements")
+    if not has_narrow:
+        _narrow_pending = False
+        if vacuum:
+            vacuum_incremental()
+        return 0
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cols = ", ".join(_col(k) for k in WIDE_KEYS)
+        pivots = ", ".join(f"AVG(CASE WHEN key = '{k}' THEN value END)" for k in WIDE_KEYS)
+        merges = ", ".join(f"{_col(k)} = COALESCE(measurements_wide.{_col(k)}, excluded.{_col(k)})" for k in WIDE_KEYS)
+        sql_copy = f"""
+            INSERT INTO measurements_wide(site, ts, {cols})
+            SELECT site, ts, {pivots}
+            FROM measurements
+            WHERE rowid > ? AND rowid <= ?
+            GROUP BY site, ts
+            ON CONFLICT(site, ts) DO UPDATE SET {merges}
+        """
+
+        last = 0
+        while True:
+            cur.execute("SELECT MIN(rowid) FROM measurements WHERE rowid > ?", (last,))
+            lo = cur.fetchone()[0]
+            if lo is None:
+                break
+            hi = lo - 1 + MIGRATE_BATCH_ROWS
+            cur.execute(sql_copy, (lo - 1, hi))
+            cur.execute("DELETE FROM measurements WHERE rowid > ? AND rowid <= ?", (lo - 1, hi))
+            moved += cur.rowcount
             conn.commit()
+            last = hi
+            time.sleep(MIGRATE_PAUSE)
 
-# ================== QC helpers ==================
-def _to_float(v):
-    if v is None:
+        # tabel sudah kosong: pembaca berhenti baca narrow dulu, baru di-drop
+        _narrow_pending = False
+        _site_hw.clear()   # ts terbaru per site bisa berubah oleh data pindahan
+        cur.execute("DROP TABLE IF EXISTS measurements")
+        conn.commit()
+        if not vacuum:
+            # halaman narrow yang bebas baru kembali ke OS setelah konversi offline
+            _warn_auto_vacuum(cur)
+
+    if vacuum:
+        vacuum_incremental()
+
+    print(f"[MIGRATE] narrow -> wide selesai: {moved} baris dalam {time.time() - t0:.1f} s")
+    return moved
+
+def migration_worker():
+    try:
+        migrate_narrow_to_wide()
+    except Exception as e:
+        print("[MIGRATE] error:", e)
+
+# ====== Ingest queue: on_message cuma enqueue, 1 thread writer yang commit ======
+ingest_queue = queue.Queue(maxsize=INGEST_QUEUE_MAX)
+ingest_stats_lock = threading.Lock()
+ingest_stats = {
+    "enqueued": 0,
+    "dropped": 0,
+    "backpressure_waits": 0,
+    "flushes": 0,
+    "flush_errors": 0,
+    "rows_written": 0,
+    "last_flush_rows": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "last_flush_dt": "-",
+    "last_error": None,
+    "late_rows": 0,            # sampel lebih tua dari ts terbaru site-nya (replay / out-of-order)
+    "overwritten_rows": 0,     # sampel yang menimpa baris (site, ts) yang sudah ada
+    "rollup_recomputed": 0,    # bucket rollup terkecil yang diagregasi ulang karena timpaan
+}
+_INGEST_STOP = object()
+_ingest_writer = None
+
+def _ingest_stat_add(name, n=1):
+    with ingest_stats_lock:
+        ingest_stats[name] += n
+
+def save_to_db(site, ts_epoch: float, data: dict, keep=None):
+    # keep: key yang ditulis ke tabel raw (None = semua); rollup tetap dari semua nilai di data
+    item = (site, ts_epoch, dict(data), keep)
+    try:
+        ingest_queue.put_nowait(item)
+    except queue.Full:
+        # backpressure: tunggu sebentar, kalau tetap penuh sampel dibuang (jangan blok loop MQTT)
+        _ingest_stat_add("backpressure_waits")
+        try:
+            ingest_queue.put(item, timeout=INGEST_PUT_TIMEOUT)
+        except queue.Full:
+            _ingest_stat_add("dropped")
+            print("[INGEST] queue penuh, sampel di-drop ts=", ts_epoch)
+            return False
+    _ingest_stat_add("enqueued")
+    return True
+
+# ====== Kompresi ingest: hanya nilai yang berubah (+ heartbeat) yang ditulis ======
+compress_stats = {"samples": 0, "values_in": 0, "values_written": 0, "rows_skipped": 0}   # dijaga data_lock
+
+def _compress_tol(cfg, ref):
+    return max(cfg[1], abs(ref) * cfg[2] / 100.0)
+
+class SampleCompressor:
+    # 1 per site (dipanggil dengan data_lock). Sampel ditahan 1 langkah: swinging door baru tahu
+    # titik n-1 perlu disimpan setelah titik n datang, jadi tiap baris (site, ts) diputuskan sekali.
+    # Hasil = (ts, data lengkap, set key yang ditulis ke raw); rollup tetap dihitung dari data lengkap.
+    __slots__ = ("pending", "last", "door")
+
+    def __init__(self):
+        self.pending = None   # (ts, data) yang belum diputuskan
+        self.last = {}        # key -> (ts, value) terakhir yang ditulis
+        self.door = {}        # key -> [slope_lo, slope_hi] dari titik terakhir yang ditulis (mode swing)
+
+    def push(self, ts, data):
+        # -> (ts, data, keep) untuk sampel sebelumnya, atau None
+        prev = self.pending
+        if prev is not None and ts <= prev[0]:
+            self.pending = (prev[0], data)   # ts sama: yang terbaru menang (sama seperti upsert DB)
+            return None
+        self.pending = (ts, data)
+        return self._decide(prev, self.pending) if prev is not None else None
+
+    def flush(self):
+        # sampel tertahan diputuskan tanpa titik berikutnya (ujung deret: titik swing selalu ditulis)
+        prev, self.pending = self.pending, None
+        return self._decide(prev, None) if prev is not None else None
+
+    def _open_door(self, a_ts, a_v, ts, v, tol):
+        dt = ts - a_ts
+        return [(v - tol - a_v) / dt, (v + tol - a_v) / dt]
+
+    def _decide(self, prev, nxt):
+        ts, data = prev
+        keep = set()
+        for k, v in data.items():
+            if v is None:
+                continue
+            cfg = COMPRESS_KEYS.get(k)
+            last = self.last.get(k)
+            if cfg is None or last is None or ts - last[0] >= COMPRESS_HEARTBEAT:
+                write = True
+            elif cfg[0] == "swing":
+                nv = nxt[1].get(k) if nxt is not None else None
+                if nv is None:
+                    write = True
+                else:
+                    # prev boleh dilewati hanya kalau garis (titik tersimpan -> titik berikutnya) masih
+                    # dalam toleransi semua titik di antaranya (door = irisan rentang slope yang diizinkan)
+                    tol = _compress_tol(cfg, last[1])
+                    d = self.door.get(k) or self._open_door(last[0], last[1], ts, v, tol)
+                    slope = (nv - last[1]) / (nxt[0] - last[0])
+                    write = not (d[0] <= slope <= d[1])
+                    if not write:
+                        lo, hi = self._open_door(last[0], last[1], nxt[0], nv, tol)
+                        self.door[k] = [max(lo, d[0]), min(hi, d[1])]
+            else:
+                write = abs(v - last[1]) > _compress_tol(cfg, last[1])
+            if write:
+                keep.add(k)
+                self.last[k] = (ts, v)
+                self.door.pop(k, None)
+                if cfg is not None and cfg[0] == "swing" and nxt is not None and nxt[1].get(k) is not None:
+                    self.door[k] = self._open_door(ts, v, nxt[0], nxt[1][k], _compress_tol(cfg, v))
+
+        compress_stats["samples"] += 1
+        compress_stats["values_in"] += sum(1 for v in data.values() if v is not None)
+        compress_stats["values_written"] += len(keep)
+        if not keep:
+            compress_stats["rows_skipped"] += 1
+        return ts, data, keep
+
+def _compress_flush_idle(now):
+    # site yang diam: sampel tertahan jangan menunggu pesan berikutnya selamanya
+    rows = []
+    with data_lock:
+        for site, st in site_states.items():
+            c = st.comp
+            if c is not None and c.pending is not None and now - c.pending[0] >= COMPRESS_HEARTBEAT:
+                r = c.flush()
+                if r is not None:
+                    rows.append((site, *r))
+    for site, ts, data, keep in rows:
+        save_to_db(site, ts, data, keep)
+
+def compress_flush_all():
+    # shutdown: sampel tertahan semua site ke antrian writer (sebelum writer di-stop)
+    _compress_flush_idle(float("inf"))
+
+def compress_stats_snapshot():
+    with data_lock:
+        out = dict(compress_stats)
+    out["ratio"] = round(out["values_written"] / out["values_in"], 4) if out["values_in"] else None
+    out["keys"] = {k: list(v) for k, v in COMPRESS_KEYS.items()}
+    out["heartbeat"] = COMPRESS_HEARTBEAT
+    return out
+
+def _site_high_water(cur, site):
+    hw = _site_hw.get(site)
+    if hw is None:
+        cur.execute("SELECT MAX(ts) FROM measurements_wide WHERE site = ?", (site,))
+        hw = _site_hw[site] = cur.fetchone()[0] or 0
+    return hw
+
+def _split_overwrites(cur, batch):
+    # sampel urut (ts > terbaru site) pasti baris baru -> rollup inkremental.
+    # sampel terlambat dicek ke DB: baris baru tetap inkremental (penjumlahan tidak peduli urutan),
+    # yang menimpa (site, ts) lama / kembar dalam batch -> bucket-nya diagregasi ulang dari raw.
+    fresh = []
+    late = {}
+    seen = set()
+    for item in batch:
+        site, ts = item[0], item[1]
+        hw = _site_high_water(cur, site)
+        if ts > hw:
+            _site_hw[site] = ts
+        else:
+            late.setdefault(site, []).append(item)
+            continue
+        seen.add((site, ts))
+        fresh.append(item)
+
+    dirty = {}
+    n_late = 0
+    for site, items in late.items():
+        n_late += len(items)
+        exist = set()
+        ts_list = list({item[1] for item in items})
+        for i in range(0, len(ts_list), 500):
+            part = ts_list[i:i + 500]
+            cur.execute(f"SELECT ts FROM measurements_wide WHERE site = ? AND ts IN ({', '.join('?' for _ in part)})", (site, *part))
+            exist.update(r[0] for r in cur.fetchall())
+        for item in items:
+            ts = item[1]
+            if ts in exist or (site, ts) in seen:
+                dirty.setdefault(site, set()).add(int(ts) // ROLLUP_RESOLUTIONS[0] * ROLLUP_RESOLUTIONS[0])
+            else:
+                seen.add((site, ts))
+                fresh.append(item)
+    return fresh, dirty, n_late
+
+def _flush_batch(conn, batch):
+    cur = conn.cursor()
+    fresh, dirty, n_late = batch, {}, 0
+    if DB_STORAGE_MODE == "wide":
+        # narrow tidak punya PK: baris kembar ikut tersimpan, rollup inkremental tetap sama dengan raw
+        fresh, dirty, n_late = _split_overwrites(cur, batch)
+        cols = ", ".join(_col(k) for k in WIDE_KEYS)
+        marks = ", ".join("?" for _ in WIDE_KEYS)
+        merges = ", ".join(f"{_col(k)} = COALESCE(excluded.{_col(k)}, {_col(k)})" for k in WIDE_KEYS)
+        rows = []
+        for site, ts, data, keep in batch:
+            if keep is None:
+                rows.append((site, ts, *[float(data[k]) if data.get(k) is not None else None for k in WIDE_KEYS]))
+            else:
+                # keep kosong tetap ditulis sebagai baris penanda (semua NULL): replay (site, ts)
+                # yang sama harus ketemu di _split_overwrites sebagai timpaan, bukan sampel baru
+                rows.append((site, ts, *[float(data[k]) if k in keep and data.get(k) is not None else None for k in WIDE_KEYS]))
+        cur.executemany(
+            f"INSERT INTO measurements_wide(site, ts, {cols}) VALUES (?, ?, {marks}) "
+            f"ON CONFLICT(site, ts) DO UPDATE SET {merges}",
+            rows,
+        )
+    else:
+        rows = [(site, ts, k, float(v)) for site, ts, data, keep in batch for k, v in data.items() if keep is None or k in keep]
+        cur.executemany("INSERT INTO measurements(site, ts, key, value) VALUES (?, ?, ?, ?)", rows)
+    n_buckets = 0
+    if _rollup_since is not None:
+        _rollup_apply_batch(cur, fresh)
+        for site, buckets in dirty.items():
+            # bucket sebelum _rollup_since belum di-rollup (nanti ikut backfill)
+            n_buckets += _rollup_recompute(cur, site, [b for b in buckets if b >= _rollup_since])
+        for site, buckets in _held_dirty(batch).items():
+            _rollup_recompute(cur, site, [b for b in buckets if b >= _rollup_since],
+                              [k for k in WIDE_KEYS if k in COMPRESS_KEYS])
+    conn.commit()
+    if n_late:
+        with ingest_stats_lock:
+            ingest_stats["late_rows"] += n_late
+            ingest_stats["overwritten_rows"] += len(batch) - len(fresh)
+            ingest_stats["rollup_recomputed"] += n_buckets
+    return len(rows)
+
+# ====== Rollup (1 min / 5 min / 1 h) ======
+# rollup_<res>(site, key, bucket, cnt, vsum, vmin, vmax) diupdate writer di transaksi yang sama dengan data raw.
+# _rollup_since: rollup lengkap untuk semua data raw dengan ts >= nilai ini (None = belum siap).
+_rollup_since = None
+_site_hw = {}   # site -> ts terbesar di measurements_wide (hanya disentuh writer)
+
+_ROLLUP_MERGE = """
+    ON CONFLICT(site, key, bucket) DO UPDATE SET
+        cnt = cnt + excluded.cnt,
+        vsum = vsum + excluded.vsum,
+        vmin = MIN(vmin, excluded.vmin),
+        vmax = MAX(vmax, excluded.vmax)
+"""
+
+def _rollup_upsert_sql(res):
+    return f"INSERT INTO rollup_{res}(site, key, bucket, cnt, vsum, vmin, vmax) VALUES (?, ?, ?, ?, ?, ?, ?) {_ROLLUP_MERGE}"
+
+def _rollup_apply_batch(cur, batch):
+    for res in ROLLUP_RESOLUTIONS:
+        acc = {}
+        for site, ts, data, _ in batch:
+            if ts < _rollup_since:
+                continue
+            b = (int(ts) // res) * res
+            for k, v in data.items():
+                if v is None or k in COMPRESS_KEYS:
+                    continue   # key terkompresi: rollup hanya dari rekonstruksi (_held_dirty)
+                v = float(v)
+                a = acc.get((site, k, b))
+                if a is None:
+                    acc[(site, k, b)] = [1, v, v, v]
+                else:
+                    a[0] += 1
+                    a[1] += v
+                    if v < a[2]:
+                        a[2] = v
+                    if v > a[3]:
+                        a[3] = v
+        if acc:
+            cur.executemany(_rollup_upsert_sql(res), [(site, k, b, *a) for (site, k, b), a in acc.items()])
+
+def _held_dirty(batch):
+    # key terkompresi di-rollup berbobot waktu dari titik tersimpan (sama dengan backfill), bukan
+    # per sampel. Titik baru di ts mengubah rekonstruksi paling jauh 2x heartbeat di kiri-kanannya
+    # (segmen titik sebelumnya berakhir di ts, titik ini dipegang sampai titik berikutnya / now).
+    # -> {site: bucket resolusi terkecil yang perlu dihitung ulang}
+    if not COMPRESS_KEYS:
+        return {}
+    base = ROLLUP_RESOLUTIONS[0]
+    gap = 2 * COMPRESS_HEARTBEAT
+    out = {}
+    for site, ts, data, keep in batch:
+        if any(data.get(k) is not None and (keep is None or k in keep) for k in COMPRESS_KEYS):
+            lo = int(ts - gap) // base * base
+            out.setdefault(site, set()).update(range(lo, int(ts + gap) + 1, base))
+    return out
+
+def _rollup_from_raw(cur, lo, hi, site=None, keys=None):
+    # data raw [lo, hi) -> rollup resolusi terkecil (semua site, atau 1 site)
+    base = ROLLUP_RESOLUTIONS[0]
+    only_site = "" if site is None else "AND site = ?"
+    extra = () if site is None else (site,)
+    for k in WIDE_KEYS if keys is None else keys:
+        if k in COMPRESS_KEYS:
+            _rollup_from_held(cur, k, lo, hi, site)
+            continue
+        if DB_STORAGE_MODE == "wide":
+            src = f"""
+                SELECT site, ?, CAST(ts / {base} AS INTEGER) * {base} AS b,
+                       COUNT({_col(k)}), SUM({_col(k)}), MIN({_col(k)}), MAX({_col(k)})
+                FROM measurements_wide
+                WHERE ts >= ? AND ts < ? AND {_col(k)} IS NOT NULL {only_site}
+                GROUP BY site, b
+            """
+        else:
+            src = f"""
+                SELECT site, key, CAST(ts / {base} AS INTEGER) * {base} AS b,
+                       COUNT(value), SUM(value), MIN(value), MAX(value)
+                FROM measurements
+                WHERE key = ? AND ts >= ? AND ts < ? {only_site}
+                GROUP BY site, b
+            """
+        cur.execute(f"INSERT INTO rollup_{base}(site, key, bucket, cnt, vsum, vmin, vmax) {src} {_ROLLUP_MERGE}", (k, lo, hi, *extra))
+
+def _rollup_from_held(cur, key, lo, hi, site=None):
+    # key terkompresi: raw bolong -> rollup dari rekonstruksi titik tersimpan, cnt = detik tercakup
+    base = ROLLUP_RESOLUTIONS[0]
+    table = "measurements_wide" if DB_STORAGE_MODE == "wide" else "measurements"
+    linear = COMPRESS_KEYS[key][0] == "swing"
+    now = time.time()
+    for s in db_sites(cur, table) if site is None else [site]:
+        pts = _stored_points(cur, key, s, lo, hi)
+        rows = [(s, key, b, a[1], a[0], a[2], a[3])
+                for b, a in _held_acc(pts, lo, hi, base, linear, now).items() if a[1]]
+        cur.executemany(f"INSERT INTO rollup_{base}(site, key, bucket, cnt, vsum, vmin, vmax) VALUES (?, ?, ?, ?, ?, ?, ?) {_ROLLUP_MERGE}", rows)
+
+def _rollup_from_level(cur, res, prev, site, lo, hi, keys=None):
+    # rollup_<prev> [lo, hi) -> rollup_<res>; per site supaya lookup tetap lewat PK (site, key, bucket)
+    keys = WIDE_KEYS if keys is None else keys
+    marks = ", ".join("?" for _ in keys)
+    cur.execute(f"""
+        INSERT INTO rollup_{res}(site, key, bucket, cnt, vsum, vmin, vmax)
+        SELECT site, key, CAST(bucket / {res} AS INTEGER) * {res} AS b,
+               SUM(cnt), SUM(vsum), MIN(vmin), MAX(vmax)
+        FROM rollup_{prev}
+        WHERE site = ? AND key IN ({marks}) AND bucket >= ? AND bucket < ?
+        GROUP BY key, b
+        {_ROLLUP_MERGE}
+    """, (site, *keys, lo, hi))
+
+def _rollup_rebuild_range(cur, lo, hi):
+    # agregasi ulang data raw [lo, hi) ; lo/hi harus kelipatan resolusi terbesar
+    _rollup_from_raw(cur, lo, hi)
+    sites = db_sites(cur, f"rollup_{ROLLUP_RESOLUTIONS[0]}")
+    prev = ROLLUP_RESOLUTIONS[0]
+    for res in ROLLUP_RESOLUTIONS[1:]:
+        for site in sites:
+            _rollup_from_level(cur, res, prev, site, lo, hi)
+        prev = res
+
+def _bucket_runs(buckets, res):
+    # bucket -> rentang [lo, hi) yang bersambung, supaya 1 query per rentang
+    runs = []
+    for b in sorted(buckets):
+        if runs and runs[-1][1] == b:
+            runs[-1][1] = b + res
+        else:
+            runs.append([b, b + res])
+    return runs
+
+def _rollup_recompute(cur, site, buckets, keys=None):
+    # bucket resolusi terkecil yang raw-nya tertimpa: hapus + agregasi ulang dari raw,
+    # level di atasnya cukup bucket induknya (dari level di bawahnya). return jumlah bucket dasar.
+    # Default key tidak terkompresi; key terkompresi dihitung ulang lewat _held_dirty.
+    if keys is None:
+        keys = [k for k in WIDE_KEYS if k not in COMPRESS_KEYS]
+    if not buckets or not keys:
+        return 0
+    marks = ", ".join("?" for _ in keys)
+    n = len(set(buckets))
+    prev = None
+    for res in ROLLUP_RESOLUTIONS:
+        buckets = {b // res * res for b in buckets}
+        for lo, hi in _bucket_runs(buckets, res):
+            cur.execute(f"DELETE FROM rollup_{res} WHERE site = ? AND key IN ({marks}) AND bucket >= ? AND bucket < ?",
+                        (site, *keys, lo, hi))
+            if prev is None:
+                _rollup_from_raw(cur, lo, hi, site, keys)
+            else:
+                _rollup_from_level(cur, res, prev, site, lo, hi, keys)
+        prev = res
+    return n
+
+def _set_meta(cur, name, value):
+    cur.execute("INSERT INTO storage_meta(name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value", (name, value))
+
+def _raw_ts_bounds(cur):
+    if DB_STORAGE_MODE == "wide":
+        cur.execute("SELECT MIN(ts), MAX(ts) FROM measurements_wide")
+    else:
+        cur.execute("SELECT MIN(ts), MAX(ts) FROM measurements")
+    return cur.fetchone()
+
+def _rollup_load(conn):
+    global _rollup_since
+    cur = conn.cursor()
+    cur.execute("SELECT value FROM storage_meta WHERE name = 'rollup_since'")
+    row = cur.fetchone()
+    _rollup_since = int(row[0]) if row else None
+
+def _rollup_maintain(conn):
+    # dipanggil writer saat idle; return True kalau masih ada kerjaan
+    global _rollup_since
+    if _narrow_pending:
+        return True  # tunggu migrasi narrow -> wide selesai
+    if _rollup_since == 0:
+        return False
+
+    top = ROLLUP_RESOLUTIONS[-1]
+    cur = conn.cursor()
+    lo_ts, hi_ts = _raw_ts_bounds(cur)
+
+    if _rollup_since is None:
+        # pertama kali: rollup jam terakhir, jam-jam sebelumnya di-backfill bertahap
+        since = 0 if hi_ts is None else (int(hi_ts) // top) * top
+        for res in ROLLUP_RESOLUTIONS:
+            cur.execute(f"DELETE FROM rollup_{res} WHERE bucket >= ?", (since,))
+        if since:
+            _rollup_rebuild_range(cur, since, 1 << 62)
+    else:
+        since = _rollup_since
+        if lo_ts is None or lo_ts >= since:
+            since = 0
+        else:
+            lo = max((since - ROLLUP_BACKFILL_CHUNK) // top * top, (int(lo_ts) // top) * top)
+            _rollup_rebuild_range(cur, lo, since)
+            since = 0 if lo <= lo_ts else lo
+
+    _set_meta(cur, "rollup_since", since)
+    conn.commit()
+    _rollup_since = since
+    if since == 0:
+        print("[ROLLUP] rollup lengkap untuk semua data")
+    return since != 0
+
+def _writer_idle(conn):
+    # return True kalau masih ada kerjaan maintenance (writer cek lagi lebih cepat)
+    try:
+        return _rollup_maintain(conn) and not _narrow_pending
+    except Exception as e:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        print("[ROLLUP] maintenance error:", e)
+        return False
+
+def db_writer_worker():
+    conn = _open_conn()
+    _rollup_load(conn)
+
+    batch = []
+    pending_rows = 0
+    deadline = None
+    stopping = False
+    retrying = False
+    idle_busy = True
+
+    while True:
+        if not stopping and not retrying and (not batch or pending_rows < INGEST_BATCH_ROWS):
+            if batch:
+                timeout = max(0.0, deadline - time.monotonic())
+            else:
+                timeout = 0.05 if idle_busy else WRITER_IDLE_TICK
+            try:
+                item = ingest_queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is None and not batch:
+                idle_busy = _writer_idle(conn)
+                continue
+            if item is _INGEST_STOP:
+                stopping = True
+            elif item is not None:
+                if not batch:
+                    deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+                batch.append(item)
+                # wide: 1 baris per sampel, narrow: 1 baris per key yang disimpan
+                if DB_STORAGE_MODE == "wide":
+                    pending_rows += 1
+                else:
+                    pending_rows += len(item[2]) if item[3] is None else len(item[3])
+                if pending_rows < INGEST_BATCH_ROWS and time.monotonic() < deadline:
+                    continue
+
+        if batch:
+            t0 = time.perf_counter()
+            try:
+                n = _flush_batch(conn, batch)
+            except Exception as e:
+                # batch disimpan & dicoba lagi; selama gagal antrian tidak dikuras -> backpressure
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                with ingest_stats_lock:
+                    ingest_stats["flush_errors"] += 1
+                    ingest_stats["last_error"] = str(e)
+                print("[INGEST] flush error:", e)
+                retrying = True
+                time.sleep(1.0)
+                continue
+
+            ms = (time.perf_counter() - t0) * 1000.0
+            with ingest_stats_lock:
+                ingest_stats["flushes"] += 1
+                ingest_stats["rows_written"] += n
+                ingest_stats["last_flush_rows"] = n
+                ingest_stats["last_flush_ms"] = round(ms, 3)
+                ingest_stats["max_flush_ms"] = round(max(ingest_stats["max_flush_ms"], ms), 3)
+                ingest_stats["last_flush_dt"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                ingest_stats["last_error"] = None
+            batch = []
+            pending_rows = 0
+            retrying = False
+
+        if stopping:
+            conn.close()
+            return
+
+def start_ingest_writer():
+    global _ingest_writer
+    if _ingest_writer is not None and _ingest_writer.is_alive():
+        return
+    _ingest_writer = threading.Thread(target=db_writer_worker, daemon=True)
+    _ingest_writer.start()
+
+def stop_ingest_writer(timeout=5.0):
+    # flush sisa antrian sebelum proses keluar
+    if _ingest_writer is None or not _ingest_writer.is_alive():
+        return
+    try:
+        ingest_queue.put(_INGEST_STOP, timeout=timeout)
+    except queue.Full:
+        return
+    _ingest_writer.join(timeout)
+
+def shutdown_ingest():
+    # dipakai atexit (WSGI) dan lifespan shutdown (ASGI): sampel tertahan kompresi
+    # masuk antrian dulu, baru writer di-stop (setelah itu antrian tidak dibaca lagi)
+    compress_flush_all()
+    stop_ingest_writer()
+
+atexit.register(shutdown_ingest)
+
+# ====== History query ======
+def _pick_rollup(interval: int):
+    # resolusi rollup paling kasar yang masih pas dengan interval
+    if _rollup_since is None:
         return None
+    best = None
+    for res in ROLLUP_RESOLUTIONS:
+        if res <= interval and interval % res == 0:
+            best = res
+    return best
+
+def history_buckets_multi(keys, start: int, interval: int, site=DEFAULT_SITE):
+    # 1 scan untuk banyak key sekaligus (1 site); hasil: {key: [(bucket_ts, avg), ...]}
+    keys = [k for k in dict.fromkeys(keys) if DB_STORAGE_MODE != "wide" or k in WIDE_KEYS]
+    if not keys:
+        return {}
+    acc = {k: {} for k in keys}
+    # dibaca sekali sebelum snapshot: migrasi baru menurunkan flag setelah narrow kosong
+    with_narrow = DB_STORAGE_MODE != "wide" or _narrow_pending
+
+    def add(k, b, sm, n):
+        if not n:
+            return
+        a = acc[k].get(b)
+        if a is None:
+            acc[k][b] = [sm, n]
+        else:
+            a[0] += sm
+            a[1] += n
+
+    def raw_part(cur, lo, hi):
+        if DB_STORAGE_MODE == "wide":
+            aggs = ", ".join(f"SUM({_col(k)}), COUNT({_col(k)})" for k in keys)
+            cur.execute(f"""
+                SELECT (CAST(ts / ? AS INTEGER) * ?) AS bucket, {aggs}
+                FROM measurements_wide
+                WHERE site = ? AND ts >= ? AND ts < ?
+                GROUP BY bucket
+            """, (interval, interval, site, lo, hi))
+            for r in cur.fetchall():
+                for i, k in enumerate(keys):
+                    add(k, int(r[0]), r[1 + 2 * i], r[2 + 2 * i])
+        if with_narrow:
+            marks = ", ".join("?" for _ in keys)
+            cur.execute(f"""
+                SELECT key, (CAST(ts / ? AS INTEGER) * ?) AS bucket, SUM(value), COUNT(value)
+                FROM measurements
+                WHERE site = ? AND key IN ({marks}) AND ts >= ? AND ts < ?
+                GROUP BY key, bucket
+            """, (interval, interval, site, *keys, lo, hi))
+            for k, b, sm, n in cur.fetchall():
+                add(k, int(b), sm, n)
+
+    def rollup_part(cur, ks, lo):
+        marks = ", ".join("?" for _ in ks)
+        cur.execute(f"""
+            SELECT key, (CAST(bucket / ? AS INTEGER) * ?) AS b, SUM(vsum), SUM(cnt)
+            FROM rollup_{res}
+            WHERE site = ? AND key IN ({marks}) AND bucket >= ?
+            GROUP BY key, b
+        """, (interval, interval, site, *ks, lo))
+        for k, b, sm, n in cur.fetchall():
+            add(k, int(b), sm, n)
+
+    # key terkompresi: raw-nya bolong -> tidak bisa SUM/COUNT, direkonstruksi dari titik tersimpan
+    held = [k for k in keys if k in COMPRESS_KEYS]
+    keys = [k for k in keys if k not in COMPRESS_KEYS]
+    end = 1 << 62
+    res = _pick_rollup(interval)
+    now = time.time()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        # semua bagian (raw / narrow / rollup) dibaca dari 1 snapshot
+        cur.execute("BEGIN")
+        try:
+            if res is None:
+                held_hi = end
+                if keys:
+                    raw_part(cur, start, end)
+            else:
+                # raw hanya untuk potongan awal yang tidak sejajar bucket rollup / belum ter-rollup
+                split = max(-(-start // res) * res, _rollup_since)
+                if keys:
+                    if split > start:
+                        raw_part(cur, start, split)
+                    rollup_part(cur, keys, split)
+                # key terkompresi: potongan awal direkonstruksi sampai batas bucket interval,
+                # jadi 1 bucket tidak pernah campuran rekonstruksi + rollup
+                held_hi = -(-split // interval) * interval
+                if held:
+                    rollup_part(cur, held, held_hi)
+            for k in held:
+                if held_hi > start:
+                    pts = _stored_points(cur, k, site, start, held_hi, with_narrow)
+                    for b, v in _held_buckets(pts, start, held_hi, interval, COMPRESS_KEYS[k][0] == "swing", now):
+                        add(k, b, v, 1)
+        except sqlite3.OperationalError:
+            # tabel narrow baru saja di-drop oleh migrasi -> ulang tanpa narrow
+            if not (DB_STORAGE_MODE == "wide" and with_narrow):
+                raise
+            conn.rollback()
+            return history_buckets_multi(keys + held, start, interval, site)
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+    return {k: [(b, float(a[0] / a[1])) for b, a in sorted(m.items())] for k, m in acc.items()}
+
+def _held_acc(pts, lo, hi, interval, linear, now):
+    # titik tersimpan (ts, v) urut -> {bucket: [jumlah v*detik, detik, min, max]} untuk [lo, hi).
+    # Tiap titik berlaku sampai titik berikutnya (step-hold, atau garis lurus untuk swing) selama
+    # jaraknya <= 2x heartbeat; lebih jauh = data memang putus, nilai terakhir cuma dipegang 1 heartbeat.
+    # Titik terakhir dipegang sampai now (sampel yang masih ditahan kompresor).
+    acc = {}
+    gap = 2 * COMPRESS_HEARTBEAT
+    for i, (t0, v0) in enumerate(pts):
+        t1, v1 = pts[i + 1] if i + 1 < len(pts) else (now, v0)
+        if t1 - t0 > gap:
+            t1, v1 = t0 + COMPRESS_HEARTBEAT, v0
+        elif not linear:
+            v1 = v0
+        if lo <= t0 < hi:
+            # titik yang bobot waktunya 0 (mis. ts == now) tetap mengisi bucket-nya
+            acc.setdefault(int(t0 // interval) * interval, [0.0, 0.0, v0, v0])
+        a, e = max(t0, lo), min(t1, hi)
+        while a < e:
+            b = int(a // interval) * interval
+            y = min(e, b + interval)
+            va = v0 + (v1 - v0) * (a - t0) / (t1 - t0)
+            vy = v0 + (v1 - v0) * (y - t0) / (t1 - t0)
+            s = acc.setdefault(b, [0.0, 0.0, va, va])
+            if not s[1]:
+                s[2] = s[3] = va
+            # rata-rata garis di [a, y) = nilai di tengahnya
+            s[0] += (va + vy) / 2 * (y - a)
+            s[1] += y - a
+            s[2] = min(s[2], va, vy)
+            s[3] = max(s[3], va, vy)
+            a = y
+    return acc
+
+def _held_buckets(pts, lo, hi, interval, linear, now):
+    # rata-rata berbobot waktu per bucket: (bucket_ts, avg)
+    return [(b, s[0] / s[1] if s[1] else s[2]) for b, s in sorted(_held_acc(pts, lo, hi, interval, linear, now).items())]
+
+def _stored_points(cur, key, site, lo, hi, with_narrow=False):
+    # titik tersimpan [lo, hi) + sekitar 2x heartbeat di kiri-kanan (nilai yang dipegang melewati batas)
+    gap = 2 * COMPRESS_HEARTBEAT
+    out = []
+    if DB_STORAGE_MODE == "wide":
+        cur.execute(f"""
+            SELECT ts, {_col(key)} FROM measurements_wide
+            WHERE site = ? AND ts >= ? AND ts < ? AND {_col(key)} IS NOT NULL
+            ORDER BY ts
+        """, (site, lo - gap, hi + gap))
+        out = cur.fetchall()
+    if DB_STORAGE_MODE != "wide" or with_narrow:
+        cur.execute("""
+            SELECT ts, value FROM measurements
+            WHERE site = ? AND key = ? AND ts >= ? AND ts < ? AND value IS NOT NULL
+            ORDER BY ts
+        """, (site, key, lo - gap, hi + gap))
+        old = cur.fetchall()
+        out = sorted(out + old) if out and old else out or old
+    return out
+
+def history_buckets(key: str, start: int, interval: int, site=DEFAULT_SITE):
+    # hasil: list (bucket_ts, avg)
+    return history_buckets_multi([key], start, interval, site).get(key, [])
+
+def ingest_stats_snapshot():
+    with ingest_stats_lock:
+        out = dict(ingest_stats)
+    out["queue_depth"] = ingest_queue.qsize()
+    out["queue_max"] = INGEST_QUEUE_MAX
+    out["db_pool"] = db_pool_stats()
+    out["compression"] = compress_stats_snapshot()
+    return out
+
+# ====== Retention (purge bertahap + checkpoint + incremental vacuum) ======
+retention_lock = threading.Lock()
+retention_stats = {
+    "last_run_dt": "-",
+    "last_duration_ms": 0.0,
+    "last_purged": {},
+    "total_purged": 0,
+    "last_freed_bytes": 0,
+    "last_reclaimed_bytes": 0,
+    "total_reclaimed_bytes": 0,
+    "db_bytes": 0,
+    "auto_vacuum": None,
+    "last_error": None,
+}
+
+def _db_pages(cur, name):
+    cur.execute(f"PRAGMA {name}")
+    return int(cur.fetchone()[0])
+
+def _purge_batches(conn, sql, params):
+    # DELETE ... LIMIT lewat subquery, commit per batch supaya writer ingest tidak lama menunggu lock
+    total = 0
+    while True:
+        cur = conn.execute(sql, params)
+        conn.commit()
+        n = cur.rowcount
+        total += max(n, 0)
+        if n < RETENTION_BATCH_ROWS:
+            return total
+        time.sleep(RETENTION_BATCH_PAUSE)
+
+def run_retention_once():
+    t0 = time.perf_counter()
+    now = int(time.time())
+    purged = {}
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        page_size = _db_pages(cur, "page_size")
+        free_before = _db_pages(cur, "freelist_count")
+        pages_before = _db_pages(cur, "page_count")
+
+        # raw hanya dibuang kalau sudah ter-rollup. Backfill jalan dari baru ke lama, data di bawah
+        # _rollup_since belum ter-rollup -> purge ditahan sampai backfill selesai (_rollup_since == 0)
+        # dan selama migrasi narrow -> wide
+        if RETENTION_RAW_DAYS and not _narrow_pending and _rollup_since == 0:
+            cutoff = now - int(RETENTION_RAW_DAYS * 86400)
+            if DB_STORAGE_MODE == "wide":
+                purged["measurements_wide"] = _purge_batches(conn, """
+                    DELETE FROM measurements_wide WHERE (site, ts) IN (
+                        SELECT site, ts FROM measurements_wide WHERE ts < ? ORDER BY ts LIMIT ?
+                    )
+                """, (cutoff, RETENTION_BATCH_ROWS))
+            else:
+                # narrow diisi berurutan waktu -> scan rowid dari awal berhenti cepat
+                try:
+                    purged["measurements"] = _purge_batches(conn, """
+                        DELETE FROM measurements WHERE rowid IN (
+                            SELECT rowid FROM measurements WHERE ts < ? LIMIT ?
+                        )
+                    """, (cutoff, RETENTION_BATCH_ROWS))
+                except sqlite3.OperationalError:
+                    pass
+
+        for res in ROLLUP_RESOLUTIONS:
+            days = RETENTION_ROLLUP_DAYS.get(res, 0)
+            if not days:
+                continue
+            cutoff = now - int(days * 86400)
+            n = 0
+            for site in db_sites(cur, f"rollup_{res}"):
+                for k in WIDE_KEYS:
+                    n += _purge_batches(conn, f"""
+                        DELETE FROM rollup_{res} WHERE site = ? AND key = ? AND bucket IN (
+                            SELECT bucket FROM rollup_{res} WHERE site = ? AND key = ? AND bucket < ? ORDER BY bucket LIMIT ?
+                        )
+                    """, (site, k, site, k, cutoff, RETENTION_BATCH_ROWS))
+            purged[f"rollup_{res}"] = n
+
+        free_after_purge = _db_pages(cur, "freelist_count")
+
+        auto_vacuum = _db_pages(cur, "auto_vacuum")
+        if auto_vacuum == 2:
+            # lewat executescript supaya pragma di-step sampai selesai (execute biasa cuma 1 halaman)
+            conn.executescript(f"PRAGMA incremental_vacuum({int(RETENTION_VACUUM_PAGES)});")
+        pages_after = _db_pages(cur, "page_count")
+
+        # PASSIVE: tidak menunggu pembaca/penulis lain
+        cur.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        cur.fetchall()
+
+    ms = (time.perf_counter() - t0) * 1000.0
+    freed = max(0, free_after_purge - free_before) * page_size
+    reclaimed = max(0, pages_before - pages_after) * page_size
+    total = sum(purged.values())
+
+    with retention_lock:
+        retention_stats["last_run_dt"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        retention_stats["last_duration_ms"] = round(ms, 3)
+        retention_stats["last_purged"] = purged
+        retention_stats["total_purged"] += total
+        retention_stats["last_freed_bytes"] = freed
+        retention_stats["last_reclaimed_bytes"] = reclaimed
+        retention_stats["total_reclaimed_bytes"] += reclaimed
+        retention_stats["db_bytes"] = pages_after * page_size
+        retention_stats["auto_vacuum"] = {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, auto_vacuum)
+        retention_stats["last_error"] = None
+
+    if total or reclaimed:
+        print(f"[RETENTION] purge {total} baris, reclaimed {reclaimed} bytes dalam {ms:.0f} ms")
+
+def retention_worker():
+    while True:
+        try:
+            run_retention_once()
+        except Exception as e:
+            with retention_lock:
+                retention_stats["last_error"] = str(e)
+            print("[RETENTION] error:", e)
+        time.sleep(RETENTION_INTERVAL)
+
+def retention_stats_snapshot():
+    with retention_lock:
+        return dict(retention_stats)
+
+# ====== Hot cache: ring buffer per key ======
+class RingSeries:
+    __slots__ = ("cap", "ts", "val", "head", "size")
+
+    def __init__(self, cap):
+        self.cap = cap
+        self.ts = array("d", bytes(8 * cap))
+        self.val = array("d", bytes(8 * cap))
+        self.head = 0   # posisi tulis berikutnya
+        self.size = 0
+
+    def append(self, ts, v):
+        self.ts[self.head] = ts
+        self.val[self.head] = v
+        self.head = (self.head + 1) % self.cap
+        if self.size < self.cap:
+            self.size += 1
+
+    def insert(self, ts, v):
+        # sampel terlambat disisipkan terurut (sampel sesudahnya digeser 1 slot); ts sama -> nilai diganti
+        if not self.size or ts > self.ts[self._phys(self.size - 1)]:
+            self.append(ts, v)
+            return
+        i = self._bisect(ts)
+        if i < self.size and self.ts[self._phys(i)] == ts:
+            self.val[self._phys(i)] = v
+            return
+        # salinan logis (memcpy di C, bukan loop Python), sisip, lalu tulis balik mulai slot 0
+        ts_l, val_l = self.window(float("-inf"))
+        if self.size == self.cap:
+            if i == 0:
+                return   # lebih tua dari semua isi ring yang penuh
+            del ts_l[0]  # ring penuh: yang tertua dibuang
+            del val_l[0]
+            i -= 1
+        ts_l.insert(i, ts)
+        val_l.insert(i, v)
+        n = len(ts_l)
+        self.ts[:n] = ts_l
+        self.val[:n] = val_l
+        self.size = n
+        self.head = n % self.cap
+
+    def _phys(self, i):
+        return (self.head - self.size + i) % self.cap
+
+    def _bisect(self, ts):
+        # indeks logis pertama dengan ts >= ts
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ts[self._phys(mid)] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def before(self, ts):
+        # (ts, val) sampel terakhir sebelum ts, atau None
+        i = self._bisect(ts)
+        if not i:
+            return None
+        p = self._phys(i - 1)
+        return self.ts[p], self.val[p]
+
+    def is_full(self):
+        return self.size == self.cap
+
+    def oldest_ts(self):
+        return self.ts[self._phys(0)] if self.size else None
+
+    def window(self, start):
+        # (ts, val) untuk sampel ts >= start, berurutan; binary search di indeks logis
+        lo = self._bisect(start)
+        if lo >= self.size:
+            return array("d"), array("d")
+        a = self._phys(lo)
+        b = self.head if self.head != 0 else self.cap
+        if a < b:
+            return self.ts[a:b], self.val[a:b]
+        return self.ts[a:] + self.ts[:b], self.val[a:] + self.val[:b]
+
+hot_lock = threading.Lock()
+hot_series = {}         # site -> {key: RingSeries}, dibuat saat site pertama kali muncul
+hot_cover_from = None   # cache lengkap untuk ts >= nilai ini (None = belum di-warm)
+
+def _hot_site(site):
+    # panggil dengan hot_lock dipegang
+    m = hot_series.get(site)
+    if m is None:
+        m = hot_series[site] = {k: RingSeries(HOT_CACHE_CAPACITY) for k in WIDE_KEYS}
+    return m
+
+def hot_cache_add(site, ts, data: dict):
+    with hot_lock:
+        m = _hot_site(site)
+        for k, v in data.items():
+            s = m.get(k)
+            if s is not None and v is not None:
+                s.insert(ts, float(v))
+
+def warm_hot_cache():
+    global hot_cover_from
+    start = int(time.time()) - HOT_CACHE_SECONDS
+    rows = []
+    # dibaca sekali sebelum snapshot: migrasi baru menurunkan flag setelah narrow kosong
+    with_narrow = DB_STORAGE_MODE != "wide" or _narrow_pending
+    with db_conn() as conn:
+        cur = conn.cursor()
+        # wide + narrow dari 1 snapshot: batch migrasi yang pindah di antara 2 query tidak bolong / dobel
+        cur.execute("BEGIN")
+        try:
+            if DB_STORAGE_MODE == "wide":
+                cols = ", ".join(_col(k) for k in WIDE_KEYS)
+                cur.execute(f"SELECT site, ts, {cols} FROM measurements_wide WHERE ts >= ? ORDER BY ts", (start,))
+                for r in cur.fetchall():
+                    rows.append((r[1], r[0], {k: r[i + 2] for i, k in enumerate(WIDE_KEYS)}))
+            if with_narrow:
+                per_ts = {}
+                for k in WIDE_KEYS:
+                    cur.execute("SELECT site, ts, value FROM measurements WHERE key = ? AND ts >= ?", (k, start))
+                    for site, ts, v in cur.fetchall():
+                        per_ts.setdefault((ts, site), {})[k] = v
+                rows += [(ts, site, data) for (ts, site), data in per_ts.items()]
+        except sqlite3.OperationalError:
+            # tabel narrow baru saja di-drop oleh migrasi -> ulang tanpa narrow
+            if not (DB_STORAGE_MODE == "wide" and with_narrow):
+                raise
+            conn.rollback()
+            return warm_hot_cache()
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+    rows.sort(key=lambda x: x[0])
+
+    with hot_lock:
+        hot_series.clear()
+        for ts, site, data in rows:
+            m = _hot_site(site)
+            for k, v in data.items():
+                if v is not None:
+                    m[k].append(ts, float(v))
+        hot_cover_from = start
+    print(f"[HOT] cache di-warm: {len(rows)} sampel, {len(hot_series)} site")
+
+def _bucket_avg(ts_arr, val_arr, interval):
+    # ts sudah urut -> batas tiap bucket dicari dengan bisect, rata-rata = sum() slice array
+    out = []
+    n = len(ts_arr)
+    i = 0
+    while i < n:
+        b = (int(ts_arr[i]) // interval) * interval
+        j = max(bisect.bisect_left(ts_arr, b + interval, i, n), i + 1)
+        out.append((b, sum(val_arr[i:j]) / (j - i)))
+        i = j
+    return out
+
+def hot_history(key: str, start: int, interval: int, site=DEFAULT_SITE):
+    # None = jendela tidak tercakup cache, caller fallback ke DB
+    seed = None
+    with hot_lock:
+        s = hot_series.get(site, {}).get(key)
+        if s is None or hot_cover_from is None:
+            return None
+        cover = hot_cover_from
+        if s.is_full():
+            cover = max(cover, s.oldest_ts())
+        if start < cover:
+            return None
+        ts_arr, val_arr = s.window(start)
+        if key in COMPRESS_KEYS:
+            seed = s.before(start)
+    if key in COMPRESS_KEYS:
+        # cache di-warm dari DB (terkompresi) bisa bolong juga -> rekonstruksi seperti history DB
+        pts = list(zip(ts_arr, val_arr))
+        if seed is not None:
+            pts.insert(0, seed)
+        return _held_buckets(pts, start, 1 << 62, interval, COMPRESS_KEYS[key][0] == "swing", time.time())
+    return _bucket_avg(ts_arr, val_arr, interval)
+
+def get_history(key: str, start: int, interval: int, site=DEFAULT_SITE):
+    out = hot_history(key, start, interval, site)
+    if out is None:
+        out = history_buckets(key, start, interval, site)
+    return out
+
+def get_history_multi(keys, start: int, interval: int, site=DEFAULT_SITE):
+    out = {}
+    cold = []
+    for k in keys:
+        h = hot_history(k, start, interval, site)
+        if h is None:
+            cold.append(k)
+        else:
+            out[k] = h
+    if cold:
+        out.update(history_buckets_multi(cold, start, interval, site))
+    return out
+
+# ====== Downsampling deret panjang (LTTB / min-max / avg) ======
+DOWNSAMPLE_METHODS = ("lttb", "minmax", "avg")
+
+def _downsample_lttb(pts, n):
+    # Largest-Triangle-Three-Buckets: titik pertama & terakhir tetap, puncak ikut terpilih
+    size = len(pts)
+    if n < 3:
+        return [pts[0], pts[-1]][:n]
+    out = [pts[0]]
+    every = (size - 2) / (n - 2)
+    a = 0
+    for i in range(n - 2):
+        lo = int(i * every) + 1
+        hi = int((i + 1) * every) + 1
+        nlo = hi
+        nhi = min(int((i + 2) * every) + 1, size)
+        if nlo >= nhi:
+            avg_t, avg_v = pts[-1]
+        else:
+            cnt = nhi - nlo
+            avg_t = sum(p[0] for p in pts[nlo:nhi]) / cnt
+            avg_v = sum(p[1] for p in pts[nlo:nhi]) / cnt
+
+        at, av = pts[a]
+        best = -1.0
+        pick = lo
+        for j in range(lo, hi):
+            t, v = pts[j]
+            area = abs((at - avg_t) * (v - av) - (at - t) * (avg_v - av))
+            if area > best:
+                best = area
+                pick = j
+        out.append(pts[pick])
+        a = pick
+    out.append(pts[-1])
+    return out
+
+def _downsample_minmax(pts, n):
+    # tiap kelompok menyumbang titik min & max (urut waktu)
+    groups = max(1, n // 2)
+    size = len(pts)
+    out = []
+    for g in range(groups):
+        lo = g * size // groups
+        hi = (g + 1) * size // groups
+        if lo >= hi:
+            continue
+        chunk = pts[lo:hi]
+        mn = min(chunk, key=lambda p: p[1])
+        mx = max(chunk, key=lambda p: p[1])
+        if mn is mx:
+            out.append(mn)
+        elif mn[0] <= mx[0]:
+            out += [mn, mx]
+        else:
+            out += [mx, mn]
+    return out
+
+def _downsample_avg(pts, n):
+    size = len(pts)
+    out = []
+    for g in range(n):
+        lo = g * size // n
+        hi = (g + 1) * size // n
+        if lo >= hi:
+            continue
+        chunk = pts[lo:hi]
+        out.append((chunk[0][0], sum(p[1] for p in chunk) / len(chunk)))
+    return out
+
+def downsample(pts, n, method="lttb"):
+    # pts: list (ts, value) urut waktu
+    if not n or n <= 0 or len(pts) <= n:
+        return pts
+    if method == "minmax":
+        return _downsample_minmax(pts, n)
+    if method == "avg":
+        return _downsample_avg(pts, n)
+    return _downsample_lttb(pts, n)
+
+def _downsample_args():
+    try:
+        n = int(request.args.get("points") or 0)
+    except ValueError:
+        n = 0
+    method = (request.args.get("method") or "lttb").strip().lower()
+    if method not in DOWNSAMPLE_METHODS:
+        method = "lttb"
+    return n, method
+
+# ================== SSE hub ==================
+# publisher (on_message / pull QC) serialize sekali, bytes-nya di-fanout ke semua client
+class EventHub:
+    # channel = site; event dengan channel None dikirim ke semua subscriber
+    def __init__(self, client_queue, min_interval):
+        self.lock = threading.Lock()
+        self.subs = {}         # queue -> channel
+        self.client_queue = client_queue
+        self.min_interval = min_interval
+        self.last_sent = {}    # (kind, channel) -> monotonic
+        self.pending = {}      # (kind, channel) -> payload yang menunggu dikirim (digabung)
+        self.cond = threading.Condition(self.lock)
+        self.deadlines = []    # heap (due, seq, key), 1 entri per key di pending
+        self.seq = 0           # pemecah seri heap (key bisa berisi None, tidak bisa dibandingkan)
+        self.flusher = None    # 1 thread untuk semua jendela coalesce, dibuat saat pertama dibutuhkan
+        self.stats = {"published": 0, "coalesced": 0, "dropped": 0}
+
+    def subscribe(self, q=None, channel=None):
+        # q: apa saja yang punya put_nowait/get_nowait (queue.Queue, AsyncSubscriber)
+        if q is None:
+            q = queue.Queue(maxsize=self.client_queue)
+        with self.lock:
+            self.subs[q] = channel
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subs.pop(q, None)
+
+    def client_count(self):
+        with self.lock:
+            return len(self.subs)
+
+    def publish(self, kind, payload, channel=None):
+        key = (kind, channel)
+        with self.lock:
+            if key in self.pending:
+                # sudah dijadwalkan (walau deadline-nya lewat): ganti isinya, tetap flusher yang kirim,
+                # supaya snapshot lama tidak terkirim setelah yang baru
+                self.stats["coalesced"] += 1
+                self.pending[key] = payload
+                return
+            now = time.monotonic()
+            wait = self.min_interval - (now - self.last_sent.get(key, -1e9))
+            if wait > 0:
+                self.seq += 1
+                heapq.heappush(self.deadlines, (now + wait, self.seq, key))
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self._flush_worker, daemon=True)
+                    self.flusher.start()
+                self.cond.notify()
+                self.pending[key] = payload
+                return
+            self.last_sent[key] = now
+        self._send(key, payload)
+
+    def _flush_worker(self):
+        while True:
+            with self.cond:
+                while not self.deadlines:
+                    self.cond.wait()
+                due, _, key = self.deadlines[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    # bisa dibangunkan lebih awal oleh deadline baru yang lebih dekat
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.deadlines)
+                payload = self.pending.pop(key, None)
+                if payload is None:
+                    continue
+                self.last_sent[key] = time.monotonic()
+            self._send(key, payload)
+
+    def _send(self, key, payload):
+        kind, channel = key
+        data = ("data: " + json.dumps({kind: payload}) + "\n\n").encode()
+        with self.lock:
+            subs = [q for q, ch in self.subs.items() if channel is None or ch == channel]
+            self.stats["published"] += 1
+        for q in subs:
+            try:
+                q.put_nowait(data)
+            except queue.Full:
+                # client lambat: buang event terlama (tiap event snapshot penuh, aman dibuang)
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(data)
+                except queue.Full:
+                    pass
+                with self.lock:
+                    self.stats["dropped"] += 1
+
+    def snapshot_stats(self):
+        with self.lock:
+            out = dict(self.stats)
+            out["clients"] = len(self.subs)
+        return out
+
+event_hub = EventHub(SSE_CLIENT_QUEUE, SSE_MIN_INTERVAL)
+
+def _qty_payload(site=DEFAULT_SITE):
+    with data_lock:
+        st = site_states.get(site)
+        if st is None:
+            return {"site": site, "ts": int(time.time()), "data": dict(DEFAULT_DATA)}
+        return {"site": site, "ts": int(st.ts or time.time()), "data": dict(st.data)}
+
+def _qc_payload():
+    with qc_lock:
+        return {
+            "ts": int(time.time()),
+            "qc_last_update": qc_last_update_dt,
+            "chlor_last_update": qc_last_update_chlor_dt,
+            "latest": dict(qc_latest),
+            "status": dict(qc_status),
+        }
+
+def _qc_empty_payload():
+    # site tanpa sheet QC
+    return {
+        "ts": int(time.time()),
+        "qc_last_update": "-",
+        "chlor_last_update": "-",
+        "latest": {p: {"ts": None, "dt": "-", "value": None} for p in QC_ORDER},
+        "status": {},
+    }
+
+def _first_event(site):
+    return {"qty": _qty_payload(site), "qc": _qc_payload() if site == QC_SITE else _qc_empty_payload()}
+
+def _qc_signature(qc):
+    return (qc.get("qc_last_update"), qc.get("chlor_last_update"),
+            qc["latest"].get("kekeruhan", {}).get("value"),
+            qc["latest"].get("sisa_chlor", {}).get("value"))
+
+# ================== QC helpers ==================
+def _to_float_text(v):
     s = str(v).strip()
     if s == "" or s.lower() in ("nan", "none"):
         return None
@@ -157,18 +1811,90 @@ def _to_float(v):
     except:
         return None
 
-def _parse_dt(s):
-    if not s:
+def _to_float(v):
+    if v is None:
         return None
+    # jalur cepat: angka biasa langsung float(), sisanya (koma, kutip, kosong) lewat _to_float_text
+    try:
+        x = float(v)
+    except (TypeError, ValueError):
+        return _to_float_text(v)
+    return None if x != x else x
+
+QC_DT_FORMATS = ["%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]
+
+def _parse_dt_fmt(s):
+    # (datetime, format yang cocok) atau (None, None)
+    if not s:
+        return None, None
     s = str(s).strip().replace('"', "")
-    fmts = ["%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]
-    for f in fmts:
+    for f in QC_DT_FORMATS:
         try:
-            return datetime.strptime(s, f)
+            return datetime.strptime(s, f), f
         except:
             pass
+    return None, None
+
+def _parse_dt(s):
+    return _parse_dt_fmt(s)[0]
+
+def _fast_dt(s, fmt):
+    # lebar tetap (YYYY-MM-DD[ HH:MM[:SS]]) -> potong string, tanpa strptime; None = bukan bentuk ini
+    n = len(s)
+    try:
+        if fmt == "%Y-%m-%d %H:%M":
+            if n == 16 and s[4] == "-" and s[7] == "-" and s[10] == " " and s[13] == ":":
+                return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]))
+        elif fmt == "%Y-%m-%d %H:%M:%S":
+            if n == 19 and s[4] == "-" and s[7] == "-" and s[10] == " " and s[13] == ":" and s[16] == ":":
+                return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+        elif fmt == "%Y-%m-%d":
+            if n == 10 and s[4] == "-" and s[7] == "-":
+                return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+    except ValueError:
+        pass
     return None
 
+class QCDateParser:
+    # 1 instance per pull: format sheet dideteksi dari nilai pertama yang valid,
+    # hasil (ts, "YYYY-MM-DD HH:MM") di-memo per string mentah
+    __slots__ = ("fmt", "memo", "hits")
+
+    def __init__(self):
+        self.fmt = None
+        self.memo = {}
+        self.hits = 0
+
+    def __call__(self, raw):
+        try:
+            out = self.memo[raw]
+            self.hits += 1
+            return out
+        except KeyError:
+            pass
+        out = self._parse(raw)
+        self.memo[raw] = out
+        return out
+
+    def _parse(self, raw):
+        if not raw:
+            return None
+        s = raw.strip()
+        if '"' in s:
+            s = s.replace('"', "")
+        dt = _fast_dt(s, self.fmt) if self.fmt else None
+        if dt is not None:
+            # bentuk lebar tetap -> string tampilan bisa langsung dipotong, tanpa strftime
+            if self.fmt == "%Y-%m-%d":
+                return int(dt.timestamp()), s + " 00:00"
+            return int(dt.timestamp()), s[:16]
+        dt, fmt = _parse_dt_fmt(s)
+        if dt is None:
+            return None
+        if self.fmt is None:
+            self.fmt = fmt
+        return int(dt.timestamp()), dt.strftime("%Y-%m-%d %H:%M")
+
 def _norm_header(s: str) -> str:
     if s is None:
         return ""
@@ -189,88 +1915,356 @@ def _find_col(fieldnames, candidates):
                 return orig
     return None
 
+def _qc_columns(fieldnames):
+    return {
+        "dt": _find_col(fieldnames, ["DateTime", "Datetime", "DATE TIME", "Date Time"]),
+        "kekeruhan": _find_col(fieldnames, ["Kekeruhan"]),
+        "warna": _find_col(fieldnames, ["Warna"]),
+        "ph": _find_col(fieldnames, ["pH", "PH"]),
+        "sisa_chlor": _find_col(fieldnames, ["Sisa Chlor", "SisaChlor"]),
+    }
+
+def _qc_parse_rows(reader, fieldnames, cols):
+    # reader = csv.reader biasa (list per baris), kolom diakses lewat indeks -> tanpa dict per baris
+    pos = {name: i for i, name in enumerate(fieldnames)}
+    if not cols["dt"]:
+        return []
+    dt_i = pos[cols["dt"]]
+    val_idx = [(p, pos[cols[p]] if cols[p] else None) for p in QC_ORDER]
+    parse_dt = QCDateParser()
+    rows = []
+    for row in reader:
+        n = len(row)
+        if n <= dt_i:
+            continue
+        parsed = parse_dt(row[dt_i])
+        if parsed is None:
+            continue
+        ts, dt_str = parsed
+        rr = {"ts": ts, "dt": dt_str}
+        for p, i in val_idx:
+            rr[p] = _to_float(row[i]) if i is not None and i < n else None
+        rows.append(rr)
+    return rows
+
+# ====== QC in-memory: kolumnar + prefix sum ======
+_NAN = float("nan")
+
+def _qc_dt_str(ts):
+    # kebalikan dari parse sheet: ts (waktu lokal) -> "YYYY-MM-DD HH:MM"
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+
+class QCSeries:
+    # baris QC terurut ts: array ts + array nilai per param (NaN = kosong),
+    # plus prefix sum/count per param -> rata-rata bucket cukup 2x bisect per bucket.
+    # string dt tidak disimpan (~16 byte/baris total), dibentuk ulang dari ts bila perlu
+    __slots__ = ("ts", "val", "csum", "ccnt")
+
+    def __init__(self, rows=()):
+        self.ts = array("q")
+        self.val = {p: array("d") for p in QC_ORDER}
+        self.csum = {p: array("d", [0.0]) for p in QC_ORDER}
+        self.ccnt = {p: array("q", [0]) for p in QC_ORDER}
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def first_ts(self):
+        return self.ts[0] if self.ts else None
+
+    def last_ts(self):
+        return self.ts[-1] if self.ts else None
+
+    def extend(self, rows):
+        # rows wajib terurut dan tidak lebih tua dari last_ts (append-only). ts di-append paling akhir:
+        # pembaca tanpa lock ambil n = len(ts) sekali, val/csum/ccnt sampai indeks n pasti sudah ada
+        for r in rows:
+            for p in QC_ORDER:
+                v = r[p]
+                s = self.csum[p]
+                c = self.ccnt[p]
+                if v is None:
+                    self.val[p].append(_NAN)
+                    s.append(s[-1])
+                    c.append(c[-1])
+                else:
+                    self.val[p].append(v)
+                    s.append(s[-1] + v)
+                    c.append(c[-1] + 1)
+            self.ts.append(r["ts"])
+
+    def rows(self):
+        for i in range(len(self.ts)):
+            ts = self.ts[i]
+            r = {"ts": ts, "dt": _qc_dt_str(ts)}
+            for p in QC_ORDER:
+                v = self.val[p][i]
+                r[p] = None if v != v else v
+            yield r
+
+    def buckets(self, param, start, interval):
+        ts = self.ts
+        n = len(ts)   # diambil sekali; extend() yang berjalan hanya menambah di belakang n
+        s = self.csum[param]
+        c = self.ccnt[param]
+        i = bisect.bisect_left(ts, start, 0, n)
+        out = []
+        while i < n:
+            b = (ts[i] // interval) * interval
+            # max(): bucket selalu maju walau interval tidak masuk akal (route sudah menolak <= 0)
+            j = max(bisect.bisect_left(ts, b + interval, i, n), i + 1)
+            cnt = c[j] - c[i]
+            if cnt:
+                out.append((b, (s[j] - s[i]) / cnt))
+            i = j
+        return out
+
+qc_rows = QCSeries()
+
+# last-N per param: dict deque (ts, value) yang diganti utuh saat swap, tidak pernah dimutasi
+qc_last = {p: deque(maxlen=QC_LAST_CACHE_N) for p in QC_ORDER}
+
+def _qc_last_from_series(series):
+    out = {}
+    for p in QC_ORDER:
+        vals = series.val[p]
+        d = deque(maxlen=QC_LAST_CACHE_N)
+        i = len(series.ts) - 1
+        while i >= 0 and len(d) < QC_LAST_CACHE_N:
+            v = vals[i]
+            if v == v:
+                d.appendleft((series.ts[i], v))
+            i -= 1
+        out[p] = d
+    return out
+
+def qc_last_n(param: str, n: int):
+    with qc_lock:
+        d = qc_last[param]
+    if len(d) >= n:
+        return list(d)[len(d) - n:]
+    # cache kurang (sheet pendek / n besar) -> DB
+    return qc_db_last(param, n)
+
+# ====== QC di SQLite: qc_samples(ts PK, dt, <param>...) ======
+def _qc_merge_by_ts(rows):
+    # baris sheet dengan menit yang sama digabung (nilai non-null terakhir menang)
+    merged = {}
+    for r in rows:
+        m = merged.get(r["ts"])
+        if m is None:
+            merged[r["ts"]] = (r["dt"], *[r[p] for p in QC_ORDER])
+        else:
+            merged[r["ts"]] = (r["dt"], *[r[p] if r[p] is not None else m[i + 1] for i, p in enumerate(QC_ORDER)])
+    return merged
+
+def _qc_latest_from_db(cur):
+    latest_map = {p: {"ts": None, "dt": "-", "value": None} for p in QC_ORDER}
+    for p in QC_ORDER:
+        cur.execute(f"SELECT ts, dt, {p} FROM qc_samples WHERE {p} IS NOT NULL ORDER BY ts DESC LIMIT 1")
+        r = cur.fetchone()
+        if r:
+            latest_map[p] = {"ts": r[0], "dt": r[1], "value": r[2]}
+
+    last_chlor_dt = latest_map["sisa_chlor"]["dt"]
+
+    cand = [latest_map[p] for p in ["kekeruhan", "warna", "ph"] if latest_map[p]["ts"] is not None]
+    last_qc_dt = max(cand, key=lambda x: x["ts"])["dt"] if cand else "-"
+    return latest_map, last_qc_dt, last_chlor_dt
+
+def _qc_store(changed, removed=()):
+    # changed: {ts: (dt, kekeruhan, warna, ph, sisa_chlor)}; return latest dari DB
+    cols = ", ".join(QC_ORDER)
+    marks = ", ".join("?" for _ in QC_ORDER)
+    sets = ", ".join(f"{p} = excluded.{p}" for p in QC_ORDER)
+    with db_conn() as conn:
+        cur = conn.cursor()
+        if changed:
+            cur.executemany(
+                f"INSERT INTO qc_samples(ts, dt, {cols}) VALUES (?, ?, {marks}) "
+                f"ON CONFLICT(ts) DO UPDATE SET dt = excluded.dt, {sets}",
+                [(ts, *v) for ts, v in changed.items()],
+            )
+        if removed:
+            cur.executemany("DELETE FROM qc_samples WHERE ts = ?", [(ts,) for ts in removed])
+        conn.commit()
+        return _qc_latest_from_db(cur)
+
+def qc_load_from_db():
+    global qc_rows, qc_last, qc_last_update_dt, qc_last_update_chlor_dt
+    start = int(time.time()) - QC_DB_WARM_DAYS * 86400
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT ts, dt, {', '.join(QC_ORDER)} FROM qc_samples WHERE ts >= ? ORDER BY ts", (start,))
+        rows = [{"ts": r[0], "dt": r[1], **{p: r[i + 2] for i, p in enumerate(QC_ORDER)}} for r in cur.fetchall()]
+        latest_map, last_qc_dt, last_chlor_dt = _qc_latest_from_db(cur)
+
+    series = QCSeries(rows)
+    last = _qc_last_from_series(series)
+    with qc_lock:
+        qc_rows = series
+        qc_last = last
+        qc_latest.clear()
+        qc_latest.update(latest_map)
+        qc_last_update_dt = last_qc_dt
+        qc_last_update_chlor_dt = last_chlor_dt
+    qc_status["row_count"] = len(rows)
+    print(f"[QC] {len(rows)} baris dimuat dari DB")
+
+def qc_db_history(param: str, start: int, interval: int):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT (CAST(ts / ? AS INTEGER) * ?) AS bucket, AVG({param})
+            FROM qc_samples
+            WHERE ts >= ? AND {param} IS NOT NULL
+            GROUP BY bucket
+            ORDER BY bucket
+        """, (interval, interval, start))
+        return [(int(b), float(v)) for b, v in cur.fetchall()]
+
+def qc_db_last(param: str, n: int):
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT ts, {param} FROM qc_samples WHERE {param} IS NOT NULL ORDER BY ts DESC LIMIT ?", (n,))
+        rows = cur.fetchall()
+    rows.reverse()
+    return [(int(ts), float(v)) for ts, v in rows]
+
+# state pull incremental (hanya dipakai thread qc_worker)
+_qc_session = requests.Session()
+_qc_http = {"etag": None, "last_modified": None, "hash": None, "text": None, "fieldnames": None, "cols": None, "bust_at": 0.0}
+
+def _qc_mark_success(mode, nbytes, parsed):
+    qc_status["last_success_dt"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    qc_status["last_error"] = None
+    qc_status["last_pull_mode"] = mode
+    qc_status["last_bytes"] = nbytes
+    qc_status["last_parsed_rows"] = parsed
+
 def pull_qc_csv_once():
-    global qc_rows, qc_latest, qc_last_update_dt, qc_last_update_chlor_dt, qc_status
+    global qc_rows, qc_last, qc_latest, qc_last_update_dt, qc_last_update_chlor_dt, qc_status
     try:
-        sep = "&" if "?" in QC_CSV_URL else "?"
-        url = QC_CSV_URL + f"{sep}_={int(time.time())}"
-
-        r = requests.get(
-            url,
-            timeout=25,
-            allow_redirects=True,
-            headers={"User-Agent": "Mozilla/5.0 (QC-Dashboard)"},
-        )
+        url = QC_CSV_URL
+        now = time.monotonic()
+        if not QC_INCREMENTAL or (QC_CACHE_BUST_EVERY and now >= _qc_http["bust_at"]):
+            sep = "&" if "?" in QC_CSV_URL else "?"
+            url = QC_CSV_URL + f"{sep}_={int(time.time())}"
+            _qc_http["bust_at"] = now + QC_CACHE_BUST_EVERY
+
+        headers = {"User-Agent": "Mozilla/5.0 (QC-Dashboard)"}
+        if QC_INCREMENTAL:
+            if _qc_http["etag"]:
+                headers["If-None-Match"] = _qc_http["etag"]
+            if _qc_http["last_modified"]:
+                headers["If-Modified-Since"] = _qc_http["last_modified"]
+
+        r = _qc_session.get(url, timeout=25, allow_redirects=True, headers=headers)
+        if r.status_code == 304:
+            _qc_mark_success("not_modified", 0, 0)
+            return
         r.raise_for_status()
 
-        f = io.StringIO(r.text)
-        reader = csv.DictReader(f)
-        fieldnames = reader.fieldnames or []
-        qc_status["headers"] = fieldnames
+        body = r.content
+        digest = hashlib.sha1(body).hexdigest()
+        _qc_http["etag"] = r.headers.get("ETag")
+        _qc_http["last_modified"] = r.headers.get("Last-Modified")
+        if QC_INCREMENTAL and digest == _qc_http["hash"]:
+            _qc_mark_success("unchanged", len(body), 0)
+            return
 
-        dt_col = _find_col(fieldnames, ["DateTime", "Datetime", "DATE TIME", "Date Time"])
-        kek_col = _find_col(fieldnames, ["Kekeruhan"])
-        war_col = _find_col(fieldnames, ["Warna"])
-        ph_col  = _find_col(fieldnames, ["pH", "PH"])
-        chl_col = _find_col(fieldnames, ["Sisa Chlor", "SisaChlor"])
+        text = r.text
+        prev = _qc_http["text"]
 
-        rows = []
-        for row in reader:
-            dt_obj = _parse_dt(row.get(dt_col) if dt_col else None)
-            if not dt_obj:
-                continue
-            ts = int(dt_obj.timestamp())
-            rows.append({
-                "ts": ts,
-                "dt": dt_obj.strftime("%Y-%m-%d %H:%M"),
-                "kekeruhan": _to_float(row.get(kek_col)) if kek_col else None,
-                "warna": _to_float(row.get(war_col)) if war_col else None,
-                "ph": _to_float(row.get(ph_col)) if ph_col else None,
-                "sisa_chlor": _to_float(row.get(chl_col)) if chl_col else None,
-            })
-
-        rows.sort(key=lambda x: x["ts"])
-
-        latest_map = {p: {"ts": None, "dt": "-", "value": None} for p in QC_ORDER}
-
-        for p in ["kekeruhan", "warna", "ph"]:
-            for rr in reversed(rows):
-                if rr.get(p) is not None:
-                    latest_map[p] = {"ts": rr["ts"], "dt": rr["dt"], "value": rr[p]}
-                    break
-
-        last_chlor_dt = "-"
-        for rr in reversed(rows):
-            if rr.get("sisa_chlor") is not None:
-                latest_map["sisa_chlor"] = {"ts": rr["ts"], "dt": rr["dt"], "value": rr["sisa_chlor"]}
-                last_chlor_dt = rr["dt"]
-                break
+        # CSV publish Google tidak diakhiri newline: baris terakhir prev harus tetap utuh di text
+        # (text lanjut dengan line break), jadi potongan baru mulai tepat di len(prev)
+        new_rows = None
+        if (QC_INCREMENTAL and prev and _qc_http["cols"]
+                and len(text) > len(prev) and text.startswith(prev)
+                and (prev.endswith("\n") or text[len(prev)] in "\r\n")):
+            # sheet cuma bertambah di bawah: parse potongan baru saja
+            with qc_lock:
+                last_ts = qc_rows.last_ts()
+            reader = csv.reader(io.StringIO(text[len(prev):]))
+            rows = _qc_parse_rows(reader, _qc_http["fieldnames"], _qc_http["cols"])
+            # baris baru dengan menit yang sudah ada / tidak urut harus digabung dengan baris lama
+            # (_qc_merge_by_ts) -> parse penuh, delta cuma untuk baris yang lebih baru dari semuanya
+            if last_ts is None or all(r["ts"] > last_ts for r in rows):
+                new_rows = rows
+
+        if new_rows is not None:
+            new_rows.sort(key=lambda x: x["ts"])
+            mode = "delta"
+
+            latest_map, last_qc_dt, last_chlor_dt = _qc_store(_qc_merge_by_ts(new_rows))
+            with qc_lock:
+                qc_rows.extend(new_rows)
+                qc_last = _qc_last_from_series(qc_rows)
+                qc_latest.clear()
+                qc_latest.update(latest_map)
+                qc_last_update_dt = last_qc_dt
+                qc_last_update_chlor_dt = last_chlor_dt
+                row_count = len(qc_rows)
+            parsed = len(new_rows)
+        else:
+            reader = csv.reader(io.StringIO(text))
+            fieldnames = next(reader, None) or []
+            qc_status["headers"] = fieldnames
+            cols = _qc_columns(fieldnames)
+
+            rows = _qc_parse_rows(reader, fieldnames, cols)
+            rows.sort(key=lambda x: x["ts"])
+            mode = "full"
+
+            # ke DB hanya yang berubah; yang hilang dari sheet (dalam rentang sheet) dihapus
+            with qc_lock:
+                old_series = qc_rows
+            old_m = _qc_merge_by_ts(old_series.rows())
+            new_m = _qc_merge_by_ts(rows)
+            changed = {ts: v for ts, v in new_m.items() if old_m.get(ts) != v}
+            removed = []
+            if rows:
+                lo, hi = rows[0]["ts"], rows[-1]["ts"]
+                removed = [ts for ts in old_m if lo <= ts <= hi and ts not in new_m]
+            latest_map, last_qc_dt, last_chlor_dt = _qc_store(changed, removed)
+
+            series = QCSeries(rows)
+            last = _qc_last_from_series(series)
+            with qc_lock:
+                qc_rows = series
+                qc_last = last
+                qc_latest.clear()
+                qc_latest.update(latest_map)
+                qc_last_update_dt = last_qc_dt
+                qc_last_update_chlor_dt = last_chlor_dt
+            row_count = len(rows)
+            parsed = len(rows)
+            _qc_http["fieldnames"] = fieldnames
+            _qc_http["cols"] = cols
+
+        _qc_http["hash"] = digest
+        _qc_http["text"] = text
 
-        cand = [latest_map["kekeruhan"]["ts"], latest_map["warna"]["ts"], latest_map["ph"]["ts"]]
-        cand = [x for x in cand if x is not None]
-        last_qc_dt = "-"
-        if cand:
-            last_qc_ts = max(cand)
-            for rr in reversed(rows):
-                if rr["ts"] == last_qc_ts:
-                    last_qc_dt = rr["dt"]
-                    break
-
-        with qc_lock:
-            qc_rows[:] = rows
-            qc_latest.clear()
-            qc_latest.update(latest_map)
-            qc_last_update_dt = last_qc_dt
-            qc_last_update_chlor_dt = last_chlor_dt
-
-        qc_status["last_success_dt"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        qc_status["last_error"] = None
-        qc_status["row_count"] = len(rows)
+        _qc_mark_success(mode, len(body), parsed)
+        qc_status["row_count"] = row_count
+
+        _publish_qc_if_changed()
 
     except Exception as e:
         qc_status["last_error"] = str(e)
         print("[QC] pull error:", e)
 
+_qc_last_published_sig = None
+
+def _publish_qc_if_changed():
+    global _qc_last_published_sig
+    qc = _qc_payload()
+    sig = _qc_signature(qc)
+    if sig != _qc_last_published_sig:
+        _qc_last_published_sig = sig
+        event_hub.publish("qc", qc, channel=QC_SITE)
+
 def qc_worker():
     pull_qc_csv_once()
     while True:
@@ -283,23 +2277,15 @@ def qc_history(param: str, hours: float, interval: int):
     now = int(time.time())
     start = now - int(hours * 3600)
 
+    # jendela yang masih dicakup memori -> bisect + prefix sum; lebih tua -> DB
     with qc_lock:
-        rows = list(qc_rows)
-
-    filtered = [r for r in rows if r["ts"] >= start and r.get(param) is not None]
-    if not filtered:
-        return []
-
-    buckets = {}
-    for r in filtered:
-        b = (r["ts"] // interval) * interval
-        buckets.setdefault(b, []).append(r[param])
-
-    out = []
-    for b in sorted(buckets.keys()):
-        vals = buckets[b]
-        out.append({"ts": int(b), "value": float(sum(vals) / max(len(vals), 1))})
-    return out
+        series = qc_rows
+    first = series.first_ts()
+    if first is not None and start >= first:
+        pts = series.buckets(param, start, interval)
+    else:
+        pts = qc_db_history(param, start, interval)
+    return [{"ts": b, "value": v} for b, v in pts]
 
 # ================== JADWAL helpers ==================
 def _ms_to_datestr(ms):
@@ -310,8 +2296,80 @@ def _ms_to_datestr(ms):
     except:
         return None
 
+def _iter_json_array(f, chunk_size=SCHEDULE_LOAD_CHUNK):
+    # parse "[elem, elem, ...]" bertahap: memori puncak ~ 1 chunk + 1 elemen
+    dec = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    state = 0   # 0: sebelum '[', 1: sebelum elemen, 2: setelah elemen
+    while True:
+        n = len(buf)
+        while pos < n and buf[pos] in " \t\r\n":
+            pos += 1
+
+        need_more = pos >= n
+        if not need_more and state == 1 and buf[pos] != "]":
+            try:
+                obj, end = dec.raw_decode(buf, pos)
+                # angka/literal di ujung buffer bisa saja terpotong ("2." dari "2.5"):
+                # elemen baru sah kalau diikuti pemisah yang sudah terbaca
+                need_more = not eof and (end >= n or buf[end] not in ",] \t\r\n")
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                need_more = True
+            if not need_more:
+                yield obj
+                pos = end
+                state = 2
+                continue
+
+        if need_more:
+            if eof:
+                raise ValueError("JSON jadwal terpotong")
+            chunk = f.read(chunk_size)
+            buf = buf[pos:] + chunk
+            pos = 0
+            eof = not chunk
+            continue
+
+        ch = buf[pos]
+        if state == 0:
+            if ch != "[":
+                raise ValueError("Format jadwal JSON harus list of objects")
+            state = 1
+        elif ch == "]":
+            return
+        elif state == 2 and ch == ",":
+            state = 1
+        else:
+            raise ValueError(f"JSON jadwal tidak valid di dekat {ch!r}")
+        pos += 1
+
+class ScheduleRow:
+    # 1 baris roster; string kategori (jabatan, lokasi, kode, jam, nama) di-intern
+    # karena berulang ribuan kali di roster setahun
+    __slots__ = ("tanggal", "nama", "jabatan", "shift_kode", "jam_kerja", "lokasi", "jam_mulai", "jam_selesai")
+
+    def __init__(self, r, shared=None):
+        tgl = r.get("tanggal")
+        if shared is not None and isinstance(tgl, int):
+            tgl = shared.setdefault(tgl, tgl)
+        self.tanggal = tgl
+        self.nama = _intern(r.get("nama"))
+        self.jabatan = _intern(r.get("jabatan"))
+        self.shift_kode = _intern(r.get("shift_kode"))
+        self.jam_kerja = _intern(r.get("jam_kerja"))
+        self.lokasi = _intern(r.get("lokasi"))
+        self.jam_mulai = _intern(r.get("jam_mulai"))
+        self.jam_selesai = _intern(r.get("jam_selesai"))
+
+def _intern(v):
+    return sys.intern(v) if type(v) is str else v
+
 def _load_schedule_file_if_changed(force=False):
-    global schedule_rows, schedule_last_loaded, schedule_last_error, _schedule_mtime
+    global schedule_rows, schedule_index, schedule_last_loaded, schedule_last_error, _schedule_mtime
 
     try:
         if not os.path.exists(SCHEDULE_JSON_FILE):
@@ -321,29 +2379,21 @@ def _load_schedule_file_if_changed(force=False):
         if (not force) and (_schedule_mtime is not None) and (mtime == _schedule_mtime):
             return  # tidak berubah
 
+        cleaned = []
+        shared = {}   # tanggal (int ms) yang sama dipakai bersama
         with open(SCHEDULE_JSON_FILE, "r", encoding="utf-8") as f:
-            rows = json.load(f)
+            # per elemen, tanpa menahan seluruh teks + list mentah di memori
+            for r in _iter_json_array(f):
+                if not isinstance(r, dict):
+                    continue
+                cleaned.append(ScheduleRow(r, shared))
 
-        if not isinstance(rows, list):
-            raise ValueError("Format jadwal JSON harus list of objects")
-
-        cleaned = []
-        for r in rows:
-            if not isinstance(r, dict):
-                continue
-            cleaned.append({
-                "tanggal": r.get("tanggal"),
-                "nama": r.get("nama"),
-                "jabatan": r.get("jabatan"),
-                "shift_kode": r.get("shift_kode"),
-                "jam_kerja": r.get("jam_kerja"),
-                "lokasi": r.get("lokasi"),
-                "jam_mulai": r.get("jam_mulai"),
-                "jam_selesai": r.get("jam_selesai"),
-            })
+        index = _build_schedule_index(cleaned)
 
         with schedule_lock:
             schedule_rows = cleaned
+            schedule_index = index
+            _schedule_resp_cache.clear()
             schedule_last_loaded = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             schedule_last_error = None
             _schedule_mtime = mtime
@@ -352,67 +2402,161 @@ def _load_schedule_file_if_changed(force=False):
         with schedule_lock:
             schedule_last_error = str(e)
             schedule_last_loaded = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            _schedule_resp_cache.clear()
         print("[SCHEDULE] load error:", e)
 
+# ====== inotify via ctypes (Linux); platform lain -> polling ======
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct("iIII")   # wd, mask, cookie, len
+
+class InotifyWatcher:
+    # watch direktori induk (bukan file) supaya replace via rename/cp tetap terdeteksi
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 gagal")
+        folder = os.path.dirname(os.path.abspath(path))
+        mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ATTRIB
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch gagal: {folder}")
+        self.name = os.fsencode(os.path.basename(path))
+
+    def wait(self, timeout=None):
+        # blok sampai ada event; True kalau ada event untuk file yang di-watch
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return False
+        buf = os.read(self.fd, 65536)
+        hit = False
+        i = 0
+        while i + _INOTIFY_EVENT.size <= len(buf):
+            _, _, _, ln = _INOTIFY_EVENT.unpack_from(buf, i)
+            i += _INOTIFY_EVENT.size
+            if buf[i:i + ln].rstrip(b"\0") == self.name:
+                hit = True
+            i += ln
+        return hit
+
+    def close(self):
+        os.close(self.fd)
+
+def _open_schedule_watcher():
+    try:
+        watcher = InotifyWatcher(SCHEDULE_JSON_FILE)
+        print("[SCHEDULE] watch via inotify")
+        return watcher
+    except Exception as e:
+        print("[SCHEDULE] inotify tidak tersedia, fallback polling:", e)
+        return None
+
 def schedule_worker():
     _load_schedule_file_if_changed(force=True)
-    while True:
-        time.sleep(SCHEDULE_RELOAD_INTERVAL)
-        _load_schedule_file_if_changed(force=False)
-
-def _schedule_for_date(date_str):
-    with schedule_lock:
-        rows = list(schedule_rows)
 
-    op = []
-    lab = []
+    use_inotify = SCHEDULE_WATCH_INOTIFY and sys.platform.startswith("linux")
+    watcher = _open_schedule_watcher() if use_inotify else None
+    retry_at = time.time() + SCHEDULE_WATCH_RETRY
 
-    for r in rows:
-        d = _ms_to_datestr(r.get("tanggal"))
-        if d != date_str:
+    while True:
+        if watcher is None:
+            time.sleep(SCHEDULE_RELOAD_INTERVAL)
+            _load_schedule_file_if_changed(force=False)
+            if use_inotify and time.time() >= retry_at:
+                watcher = _open_schedule_watcher()
+                retry_at = time.time() + SCHEDULE_WATCH_RETRY
             continue
 
-        nama = (r.get("nama") or "").strip()
-        jab = (r.get("jabatan") or "").strip().lower()
-        kode = (r.get("shift_kode") or "").strip().upper()
-        jam  = (r.get("jam_kerja") or "").strip()
-        lokasi = (r.get("lokasi") or "").strip().upper()
+        try:
+            if watcher.wait():
+                # editor sering menulis beberapa kali -> tunggu sampai tenang
+                while watcher.wait(SCHEDULE_WATCH_DEBOUNCE):
+                    pass
+                _load_schedule_file_if_changed(force=False)
+        except OSError as e:
+            # fd inotify rusak -> thread jangan mati: polling dulu, watcher dibuat ulang nanti
+            print("[SCHEDULE] inotify error, fallback polling:", e)
+            try:
+                watcher.close()
+            except OSError:
+                pass
+            watcher = None
+            retry_at = time.time() + SCHEDULE_WATCH_RETRY
+
+def _build_schedule_index(rows):
+    # filter + normalisasi sekali saat load, dikelompokkan per tanggal
+    index = {}
+    day_cache = {}   # tanggal ms -> "YYYY-MM-DD" (banyak baris berbagi tanggal)
 
+    for r in rows:
         # hanya yang benar-benar kerja (bukan OFF)
-        if not r.get("jam_mulai") or not r.get("jam_selesai"):
+        if not r.jam_mulai or not r.jam_selesai:
             continue
 
-        # ============ OPERATOR PRODUKSI: hanya WTP3 + hanya yang ada "12" ============
-        if jab == "operator produksi":
-            if lokasi != "WTP3":
-                continue
+        jab = (r.jabatan or "").strip().lower()
+        kode = sys.intern((r.shift_kode or "").strip().upper())
+        lokasi = sys.intern((r.lokasi or "").strip().upper())
 
+        # ============ OPERATOR PRODUKSI: per lokasi (= site) + hanya yang ada "12" ============
+        if jab == "operator produksi":
             # ambil yang ada angka 12 saja (M12, P12, S12, N12, 12, A12, dll)
-            if "12" not in kode:
+            if not lokasi or "12" not in kode:
                 continue
-
-            op.append({
-                "nama": nama,
-                "kode": kode or "-",
-                "jam": jam or "-",
-                "lokasi": "WTP3",
-            })
-
+            slot = 0
         # ============ ANALIS LAB: hanya LAB ============
         elif jab == "analis laboratorium":
             if lokasi != "LAB":
                 continue
+            slot = 1
+        else:
+            continue
 
-            lab.append({
-                "nama": nama,
-                "kode": kode or "-",
-                "jam": jam or "-",
-                "lokasi": "LAB",
-            })
+        ms = r.tanggal
+        try:
+            d = day_cache[ms]
+        except (KeyError, TypeError):
+            d = _ms_to_datestr(ms)
+            try:
+                day_cache[ms] = d
+            except TypeError:
+                pass
+        if d is None:
+            continue
 
-    op.sort(key=lambda x: x["nama"])
-    lab.sort(key=lambda x: x["nama"])
-    return op, lab
+        entry = index.get(d)
+        if entry is None:
+            entry = index[d] = ({}, [])
+        item = {
+            "nama": sys.intern((r.nama or "").strip()),
+            "kode": kode or "-",
+            "jam": sys.intern((r.jam_kerja or "").strip() or "-"),
+            "lokasi": lokasi,
+        }
+        if slot == 0:
+            entry[0].setdefault(lokasi, []).append(item)
+        else:
+            entry[1].append(item)
+
+    for ops, lab in index.values():
+        for op in ops.values():
+            op.sort(key=lambda x: x["nama"])
+        lab.sort(key=lambda x: x["nama"])
+    return index
+
+_EMPTY_SCHEDULE = ({}, [])
+
+def _schedule_for_date(date_str, site=DEFAULT_SITE):
+    # operator = lokasi sama dengan site, lab dipakai bersama semua site;
+    # list yang dikembalikan dipakai bersama -> jangan dimutasi pemanggil
+    with schedule_lock:
+        ops, lab = schedule_index.get(date_str, _EMPTY_SCHEDULE)
+    return ops.get(site.upper(), []), lab
 
 # ================== FLASK ==================
 app = Flask(__name__)
@@ -1218,7 +3362,16 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
       : {hour:"2-digit", minute:"2-digit"}
     );
   }
+  // site dari URL halaman (/?site=WTP1) ikut ke semua /api/* dan /events
+  const SITE = new URLSearchParams(location.search).get("site") || "";
+  function withSite(url){
+    if (!SITE) return url;
+    const sep = url.includes("?") ? "&" : "?";
+    return url + sep + "site=" + encodeURIComponent(SITE);
+  }
+
   async function fetchJSON(url){
+    url = withSite(url);
     const sep = url.includes("?") ? "&" : "?";
     const u = url + sep + "_=" + Date.now();
     const res = await fetch(u, { cache: "no-store" });
@@ -1226,6 +3379,14 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
     return await res.json();
   }
 
+  // untuk endpoint ber-ETag: tanpa cache-buster, browser revalidasi (304 = pakai cache)
+  async function fetchJSONRevalidate(url){
+    url = withSite(url);
+    const res = await fetch(url, { cache: "no-cache" });
+    if (!res.ok) throw new Error(`HTTP ${res.status} ${url}`);
+    return await res.json();
+  }
+
   // ===== THEME =====
   function applyTheme(theme){
     document.body.dataset.theme = theme;
@@ -1538,10 +3699,19 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
   async function initQtyTileHistory(){
     const hours = 1;
     const interval = QTY_TILE_SHIFT_SEC;
+    if (!qtyTileKeys.length) return;
+
+    try{
+      const j = await fetchJSON(`/api/history?keys=${qtyTileKeys.join(",")}&hours=${hours}&interval=${interval}&limit=${QTY_TILE_POINTS}`);
+      const tsArr = j.ts || [];
+
+      for (const key of qtyTileKeys){
+        const vals = (j.series && j.series[key]) || [];
+        const arr = [];
+        for (let i = 0; i < tsArr.length; i++){
+          if (vals[i] != null) arr.push({ ts: tsArr[i], value: vals[i] });
+        }
 
-    for (const key of qtyTileKeys){
-      try{
-        const arr = await fetchJSON(`/api/history/${key}?hours=${hours}&interval=${interval}&limit=${QTY_TILE_POINTS}`);
         const s = ensureQtySeries(key);
         s.labels = arr.map(p => fmtTime(p.ts, true));
         s.data   = arr.map(p => p.value);
@@ -1551,13 +3721,19 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
           s.lastBucket = null;
         }
         renderQtyTile(key);
-      }catch(e){
-        console.log("INIT QTY TILE ERR", key, e);
       }
+    }catch(e){
+      console.log("INIT QTY TILE ERR", e);
     }
   }
 
   // ===== Big chart kuantitas =====
+  // server me-downsample ke ~1 titik per 2 px lebar canvas
+  function bigChartPoints(canvas){
+    const w = (canvas && canvas.clientWidth) ? canvas.clientWidth : 1200;
+    return clamp(Math.round(w / 2), 100, 1000);
+  }
+
   let qtyChart = null;
   function qtyLabel(key){
     const map = {
@@ -1578,9 +3754,11 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
     const key = document.getElementById("qtyParam").value;
     const hours = Number(document.getElementById("qtyRange").value);
     const interval = (hours <= 1) ? 60 : (hours <= 12 ? 120 : 300);
-    const arr = await fetchJSON(`/api/history/${key}?hours=${hours}&interval=${interval}`);
+    const canvas = document.getElementById("chartBig");
+    const points = bigChartPoints(canvas);
+    const arr = await fetchJSON(`/api/history/${key}?hours=${hours}&interval=${interval}&points=${points}&method=lttb`);
 
-    const ctx = document.getElementById("chartBig").getContext("2d");
+    const ctx = canvas.getContext("2d");
     if (qtyChart) qtyChart.destroy();
     qtyChart = new Chart(ctx, {
       type: "line",
@@ -1663,9 +3841,16 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
   }
 
   async function refreshQCTileCharts(){
+    let all;
+    try{
+      all = await fetchJSON(`/api/qc/last?n=5`);
+    }catch(e){
+      console.log("QC TILE REFRESH ERR", e);
+      return;
+    }
     for (const k of qcTileKeys){
       try{
-        const arr = await fetchJSON(`/api/qc/last/${k}?n=5`);
+        const arr = all[k] || [];
         const s = ensureQCTileSeries(k);
         s.labels = arr.map(p => fmtTime(p.ts, false));
         s.data   = arr.map(p => p.value);
@@ -1686,9 +3871,11 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
     const param = document.getElementById("qcParam").value;
     const hours = Number(document.getElementById("qcRange").value);
     const interval = (hours <= 24) ? 3600 : (hours <= 168 ? 7200 : 21600);
-    const arr = await fetchJSON(`/api/qc/history/${param}?hours=${hours}&interval=${interval}`);
+    const canvas = document.getElementById("qcBig");
+    const points = bigChartPoints(canvas);
+    const arr = await fetchJSON(`/api/qc/history/${param}?hours=${hours}&interval=${interval}&points=${points}&method=lttb`);
 
-    const ctx = document.getElementById("qcBig").getContext("2d");
+    const ctx = canvas.getContext("2d");
     if (qcBigChart) qcBigChart.destroy();
     qcBigChart = new Chart(ctx, {
       type:"line",
@@ -1944,7 +4131,7 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
   }
   async function loadSchedule(dateStr){
     try{
-      const j = await fetchJSON(`/api/schedule?date=${encodeURIComponent(dateStr)}`);
+      const j = await fetchJSONRevalidate(`/api/schedule?date=${encodeURIComponent(dateStr)}`);
       renderScheduleRows("schBodyOp", j.operator || []);
       renderScheduleRows("schBodyLab", j.lab || []);
     }catch(e){
@@ -1990,7 +4177,7 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
   // ===== SSE =====
   function startSSE(){
     try{
-      const es = new EventSource("/events");
+      const es = new EventSource(withSite("/events"));
       es.onmessage = async (ev) => {
         try{
           const j = JSON.parse(ev.data);
@@ -2097,15 +4284,38 @@ body[data-theme="light"] .estMini{ background: rgba(7,20,39,0.03); }
 
 @app.after_request
 def add_no_cache_headers(resp):
+    if "ETag" in resp.headers:
+        # response ber-ETag boleh disimpan browser, tapi wajib revalidasi (304)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     resp.headers["Pragma"] = "no-cache"
     resp.headers["Expires"] = "0"
     return resp
 
+def _site_arg():
+    # ?site=... di semua route; kosong = DEFAULT_SITE
+    return (request.args.get("site") or "").strip() or DEFAULT_SITE
+
+def _interval_arg(default):
+    # ?interval=... dalam detik; <= 0 -> None (route jawab 400, bucket tidak bisa maju)
+    n = int(request.args.get("interval", default))
+    return n if n > 0 else None
+
+def _bad_interval():
+    return jsonify({"error": "interval harus > 0"}), 400
+
+def known_sites():
+    with data_lock:
+        out = set(site_states)
+    with hot_lock:
+        out.update(hot_series)
+    out.update(site for _, site in MQTT_TOPICS if not site.startswith("$"))
+    return sorted(out)
+
 @app.route("/")
 def index():
-    with data_lock:
-        data = dict(latest_data)
+    data = _qty_payload(_site_arg())["data"]
     return render_template_string(
         HTML_PAGE,
         data=data,
@@ -2117,144 +4327,185 @@ def index():
 # ===== API kuantitas =====
 @app.route("/api/latest")
 def api_latest():
-    with data_lock:
-        data = dict(latest_data)
-        ts = int(latest_ts_epoch or time.time())
-    return jsonify({"ts": ts, "data": data})
+    return jsonify(_qty_payload(_site_arg()))
+
+@app.route("/api/sites")
+def api_sites():
+    return jsonify({"default": DEFAULT_SITE, "qc_site": QC_SITE, "sites": known_sites()})
 
 @app.route("/api/history/<key>")
 def api_history(key):
     hours = float(request.args.get("hours", 24))
-    interval = int(request.args.get("interval", 60))
+    interval = _interval_arg(60)
+    if interval is None:
+        return _bad_interval()
     now = int(time.time())
     start = now - int(hours * 3600)
 
-    with sqlite3.connect(DB_PATH, timeout=10) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT
-                (CAST(ts / ? AS INTEGER) * ?) AS bucket,
-                AVG(value) AS avg_value
-            FROM measurements
-            WHERE key = ? AND ts >= ?
-            GROUP BY bucket
-            ORDER BY bucket
-        """, (interval, interval, key, start))
-        rows = cur.fetchall()
+    pts = get_history(key, start, interval, _site_arg())
+
+    limit = request.args.get("limit")
+    if limit:
+        try:
+            n = max(1, int(limit))
+            pts = pts[-n:]
+        except:
+            pass
+
+    n_points, method = _downsample_args()
+    pts = downsample(pts, n_points, method)
+
+    return jsonify([{"ts": b, "value": v} for b, v in pts])
+
+@app.route("/api/history")
+def api_history_multi():
+    # ?keys=A,B,C -> deret yang sejajar: {"ts": [...], "series": {"A": [...], ...}} (null = bucket kosong)
+    keys = [k.strip() for k in (request.args.get("keys") or "").split(",") if k.strip()]
+    if not keys:
+        keys = list(WIDE_KEYS)
+    hours = float(request.args.get("hours", 24))
+    interval = _interval_arg(60)
+    if interval is None:
+        return _bad_interval()
+    now = int(time.time())
+    start = now - int(hours * 3600)
 
-    out = [{"ts": int(r[0]), "value": float(r[1])} for r in rows]
+    per_key = get_history_multi(keys, start, interval, _site_arg())
+    ts_all = sorted({b for rows in per_key.values() for b, _ in rows})
 
     limit = request.args.get("limit")
     if limit:
         try:
             n = max(1, int(limit))
-            out = out[-n:]
+            ts_all = ts_all[-n:]
         except:
             pass
 
-    return jsonify(out)
+    series = {}
+    for k in keys:
+        m = dict(per_key.get(k, []))
+        series[k] = [m.get(b) for b in ts_all]
+
+    return jsonify({"interval": interval, "ts": ts_all, "series": series})
+
+@app.route("/api/ingest/stats")
+def api_ingest_stats():
+    return jsonify(ingest_stats_snapshot())
+
+@app.route("/api/mqtt/stats")
+def api_mqtt_stats():
+    return jsonify(mqtt_pipeline.snapshot_stats())
+
+@app.route("/api/retention/stats")
+def api_retention_stats():
+    return jsonify(retention_stats_snapshot())
 
 # ===== API QC =====
 @app.route("/api/qc/latest")
 def api_qc_latest():
-    with qc_lock:
-        payload = {
-            "ts": int(time.time()),
-            "qc_last_update": qc_last_update_dt,
-            "chlor_last_update": qc_last_update_chlor_dt,
-            "latest": qc_latest,
-            "status": qc_status,
-        }
-    return jsonify(payload)
+    if _site_arg() != QC_SITE:
+        return jsonify(_qc_empty_payload())
+    return jsonify(_qc_payload())
 
 @app.route("/api/qc/history/<param>")
 def api_qc_history(param):
     hours = float(request.args.get("hours", 24))
-    interval = int(request.args.get("interval", 3600))
-    return jsonify(qc_history(param, hours=hours, interval=interval))
+    interval = _interval_arg(3600)
+    if interval is None:
+        return _bad_interval()
+    if _site_arg() != QC_SITE:
+        return jsonify([])
+    out = qc_history(param, hours=hours, interval=interval)
+
+    n_points, method = _downsample_args()
+    if n_points and len(out) > n_points:
+        pts = downsample([(r["ts"], r["value"]) for r in out], n_points, method)
+        out = [{"ts": t, "value": v} for t, v in pts]
+
+    return jsonify(out)
 
 @app.route("/api/qc/last/<param>")
 def api_qc_last(param):
     n = int(request.args.get("n", 5))
-    if param not in QC_PARAMS:
+    if param not in QC_PARAMS or _site_arg() != QC_SITE:
         return jsonify([])
+    return jsonify([{"ts": ts, "value": v} for ts, v in qc_last_n(param, max(1, n))])
 
-    with qc_lock:
-        rows = list(qc_rows)
-
-    out = []
-    for rr in reversed(rows):
-        v = rr.get(param)
-        if v is None:
-            continue
-        out.append({"ts": rr["ts"], "value": float(v)})
-        if len(out) >= n:
-            break
-
-    out.reverse()
-    return jsonify(out)
+@app.route("/api/qc/last")
+def api_qc_last_all():
+    n = max(1, int(request.args.get("n", 5)))
+    if _site_arg() != QC_SITE:
+        return jsonify({p: [] for p in QC_ORDER})
+    return jsonify({p: [{"ts": ts, "value": v} for ts, v in qc_last_n(p, n)] for p in QC_ORDER})
 
 # ===== API JADWAL =====
-@app.route("/api/schedule")
-def api_schedule():
-    date_str = (request.args.get("date") or "").strip()
-    if not date_str:
-        date_str = datetime.now().strftime("%Y-%m-%d")
-
-    op, lab = _schedule_for_date(date_str)
-
+def _schedule_response_body(date_str, site):
+    # (etag, bytes) per tanggal+site; ETag kuat dari mtime file + tanggal + site (+ error bila ada)
     with schedule_lock:
+        hit = _schedule_resp_cache.get((date_str, site))
+        if hit is not None:
+            return hit
+        mtime = _schedule_mtime
         meta = {
             "loaded_at": schedule_last_loaded,
             "error": schedule_last_error,
             "file": SCHEDULE_JSON_FILE,
         }
 
-    return jsonify({
+    op, lab = _schedule_for_date(date_str, site)
+    body = app.json.dumps({
         "date": date_str,
+        "site": site,
         "operator": op,
         "lab": lab,
         "meta": meta
-    })
+    }).encode("utf-8")
+
+    tag = f"{int((mtime or 0) * 1e6):x}-{date_str}-{hashlib.sha1(site.encode('utf-8')).hexdigest()[:8]}"
+    if meta["error"]:
+        tag += "-e" + hashlib.sha1(meta["error"].encode("utf-8")).hexdigest()[:8]
+    out = (tag, body)
+
+    with schedule_lock:
+        # hanya simpan kalau belum ada reload di antaranya
+        if _schedule_mtime == mtime and schedule_last_error == meta["error"]:
+            if len(_schedule_resp_cache) >= SCHEDULE_RESP_CACHE_MAX:
+                _schedule_resp_cache.clear()
+            _schedule_resp_cache[(date_str, site)] = out
+    return out
+
+@app.route("/api/schedule")
+def api_schedule():
+    date_str = (request.args.get("date") or "").strip()
+    if not date_str:
+        date_str = datetime.now().strftime("%Y-%m-%d")
+
+    tag, body = _schedule_response_body(date_str, _site_arg())
+    if request.if_none_match.contains(tag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype="application/json")
+    resp.set_etag(tag)
+    return resp
 
 # ===== SSE stream =====
 @app.route("/events")
 def events():
-    def gen():
-        last_qc_sent = None
-        last_qty_sent = None
-        while True:
-            time.sleep(2)
+    site = _site_arg()
 
-            with data_lock:
-                qty = {"ts": int(latest_ts_epoch or time.time()), "data": dict(latest_data)}
-            with qc_lock:
-                qc = {
-                    "ts": int(time.time()),
-                    "qc_last_update": qc_last_update_dt,
-                    "chlor_last_update": qc_last_update_chlor_dt,
-                    "latest": dict(qc_latest),
-                    "status": dict(qc_status),
-                }
-
-            qty_sig = (qty["ts"], qty["data"].get("TOTAL_FLOW_DST"), qty["data"].get("PRESSURE_DST"), qty["data"].get("LVL_RES_WTP3"))
-            qc_sig = (qc.get("qc_last_update"), qc.get("chlor_last_update"),
-                      qc["latest"].get("kekeruhan", {}).get("value"),
-                      qc["latest"].get("sisa_chlor", {}).get("value"))
-
-            send_qty = (qty_sig != last_qty_sent)
-            send_qc = (qc_sig != last_qc_sent)
-
-            if send_qty or send_qc:
-                msg = {}
-                if send_qty:
-                    msg["qty"] = qty
-                    last_qty_sent = qty_sig
-                if send_qc:
-                    msg["qc"] = qc
-                    last_qc_sent = qc_sig
-
-                yield f"data: {json.dumps(msg)}\n\n"
+    def gen():
+        q = event_hub.subscribe(channel=site)
+        try:
+            # snapshot awal langsung dikirim, selanjutnya event dari hub (site ini saja)
+            first = _first_event(site)
+            yield f"data: {json.dumps(first)}\n\n"
+            while True:
+                try:
+                    yield q.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": ping\n\n"
+        finally:
+            event_hub.unsubscribe(q)
 
     headers = {
         "Content-Type": "text/event-stream",
@@ -2264,88 +4515,558 @@ def events():
     }
     return Response(gen(), headers=headers)
 
+@app.route("/api/events/stats")
+def api_events_stats():
+    return jsonify(event_hub.snapshot_stats())
+
+@app.route("/api/webhook/stats")
+def api_webhook_stats():
+    return jsonify(webhook_forwarder.snapshot_stats())
+
+# ================== WEBHOOK FORWARD ==================
+# Normal: 1 sampel -> POST payload lama (dict data). Saat endpoint down sampel
+# masuk spool jsonl di disk; setelah pulih dikirim batch: [{"ts":..., <data>}, ...]
+class WebhookForwarder:
+    def __init__(self, url, spool_path):
+        self.url = url
+        self.spool_path = spool_path
+        self.pos_path = spool_path + ".pos"   # offset byte baris spool berikutnya yang belum terkirim
+        self.q = queue.Queue(maxsize=WEBHOOK_QUEUE_MAX)
+        self.lock = threading.Lock()           # spool + stats (diubah thread MQTT dan thread pengirim)
+        self.offset = self._load_offset()
+        self.spooled = self._count_lines(self.offset, None)
+        self.session = requests.Session()
+        self.thread = None
+        self.stats = {"sent": 0, "sent_batches": 0, "failed_posts": 0, "rejected": 0,
+                      "spooled_total": 0, "spool_dropped": 0, "last_error": None, "last_ok_ts": None}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def submit(self, ts, data):
+        # dipanggil dari thread MQTT: tidak pernah blok
+        try:
+            self.q.put_nowait((ts, data))
+        except queue.Full:
+            self._spool_append([(ts, data)])
+
+    def _stat(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    # ====== spool jsonl: dibaca maju dari offset, file dikosongkan saat semua terkirim ======
+    def _load_offset(self):
+        try:
+            with open(self.pos_path, "r") as f:
+                off = int(f.read().strip() or 0)
+            return off if off <= os.path.getsize(self.spool_path) else 0
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _save_offset(self):
+        tmp = self.pos_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(self.offset))
+        os.replace(tmp, self.pos_path)
+
+    def _count_lines(self, start, end):
+        try:
+            with open(self.spool_path, "rb") as f:
+                f.seek(start)
+                data = f.read() if end is None else f.read(max(0, end - start))
+        except FileNotFoundError:
+            return 0
+        return data.count(b"\n")
+
+    def _spool_read(self, n):
+        # -> (items, offset sesudah baris terakhir yang dibaca, jumlah baris); panggil dengan lock
+        items = []
+        lines = 0
+        off = self.offset
+        try:
+            with open(self.spool_path, "rb") as f:
+                f.seek(off)
+                while lines < n:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        break   # EOF / baris yang masih setengah ditulis
+                    off += len(line)
+                    lines += 1
+                    try:
+                        j = json.loads(line)
+                        items.append((j["ts"], j["data"]))
+                    except:
+                        pass   # baris rusak (mis. mati saat menulis) dilewati
+        except FileNotFoundError:
+            pass
+        return items, off, lines
+
+    def _advance(self, end):
+        # panggil dengan lock; offset bisa sudah maju duluan karena spool penuh (baris tertua dibuang)
+        if end > self.offset:
+            self.spooled -= self._count_lines(self.offset, end)
+            self.offset = end
+        if self.spooled <= 0:
+            with open(self.spool_path, "wb"):
+                pass   # semua terkirim: kosongkan
+            self.offset = 0
+            self.spooled = 0
+        self._save_offset()
+
+    def _compact(self):
+        # dipanggil thread pengirim saja (di luar POST): buang bagian yang sudah terkirim kalau dominan
+        with self.lock:
+            try:
+                size = os.path.getsize(self.spool_path)
+            except FileNotFoundError:
+                return
+            if self.offset < (1 << 20) or self.offset * 2 < size:
+                return
+            tmp = self.spool_path + ".tmp"
+            with open(self.spool_path, "rb") as src, open(tmp, "wb") as dst:
+                src.seek(self.offset)
+                while True:
+                    chunk = src.read(1 << 20)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            os.replace(tmp, self.spool_path)
+            self.offset = 0
+            self._save_offset()
+
+    def _spool_append(self, items):
+        with self.lock:
+            with open(self.spool_path, "ab") as f:
+                for ts, data in items:
+                    f.write((json.dumps({"ts": ts, "data": data}) + "\n").encode("utf-8"))
+            self.spooled += len(items)
+            self.stats["spooled_total"] += len(items)
+            if self.spooled > WEBHOOK_SPOOL_MAX:
+                # sampel tertua dibuang dengan memajukan offset (tanpa tulis ulang file)
+                _, off, lines = self._spool_read(self.spooled - WEBHOOK_SPOOL_MAX)
+                self.stats["spool_dropped"] += lines
+                self._advance(off)
+
+    def _drain_queue(self):
+        items = []
+        while True:
+            try:
+                items.append(self.q.get_nowait())
+            except queue.Empty:
+                return items
+
+    def flush_to_spool(self):
+        # saat shutdown: sisa antrean memori jangan hilang
+        items = self._drain_queue()
+        if items:
+            self._spool_append(items)
+
+    # ====== kirim ======
+    def _post(self, body):
+        try:
+            r = self.session.post(self.url, headers={"Content-Type": "application/json"},
+                                  data=body, timeout=WEBHOOK_TIMEOUT)
+        except Exception as e:
+            with self.lock:
+                self.stats["failed_posts"] += 1
+                self.stats["last_error"] = str(e)
+            return False
+        if r.status_code >= 500 or r.status_code == 429:
+            with self.lock:
+                self.stats["failed_posts"] += 1
+                self.stats["last_error"] = f"HTTP {r.status_code}"
+            return False
+        with self.lock:
+            if r.status_code >= 400:
+                # ditolak permanen: retry tidak akan menolong
+                self.stats["rejected"] += 1
+                self.stats["last_error"] = f"HTTP {r.status_code} (dibuang)"
+            self.stats["last_ok_ts"] = int(time.time())
+        if r.status_code >= 400:
+            print("[WEBHOOK] ditolak:", r.status_code)
+        return True
+
+    def _run(self):
+        backoff = WEBHOOK_BACKOFF_MIN
+        while True:
+            if self.spooled == 0:
+                ts, data = self.q.get()
+                if self._post(json.dumps(data)):
+                    self._stat("sent")
+                    backoff = WEBHOOK_BACKOFF_MIN
+                    continue
+                self._spool_append([(ts, data)])
+            else:
+                # mengejar: antrean memori ikut ke spool dulu supaya urutan terjaga
+                pending = self._drain_queue()
+                if pending:
+                    self._spool_append(pending)
+                self._compact()
+                with self.lock:
+                    batch, end, lines = self._spool_read(WEBHOOK_BATCH_MAX)
+                    if not lines:
+                        self.spooled = 0             # tidak ada baris utuh lagi (sisa tulisan setengah jadi)
+                        self._advance(self.offset)
+                        continue
+                body = json.dumps([{"ts": ts, **data} for ts, data in batch])
+                if not batch or self._post(body):
+                    with self.lock:
+                        self._advance(end)
+                        self.stats["sent"] += len(batch)
+                        self.stats["sent_batches"] += 1 if batch else 0
+                    backoff = WEBHOOK_BACKOFF_MIN
+                    continue
+
+            print(f"[WEBHOOK] gagal kirim, retry {backoff}s ({self.spooled} sampel di spool)")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, WEBHOOK_BACKOFF_MAX)
+
+    def snapshot_stats(self):
+        with self.lock:
+            out = dict(self.stats)
+            out["spooled"] = self.spooled
+        out["queue_depth"] = self.q.qsize()
+        return out
+
+webhook_forwarder = WebhookForwarder(WEB_APP_URL, WEBHOOK_SPOOL_FILE)
+atexit.register(webhook_forwarder.flush_to_spool)
+
+# ================== DECODER PAYLOAD MQTT ==================
+# Bentuk envelope dipelajari dari pesan pertama, lalu extractor langsung
+# (raw key -> NUMERIC_KEY) disusun sekali dan dipakai selama set key sama.
+_json_loads = orjson.loads if orjson is not None else json.loads
+_JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+def _env_data(j):
+    d = j.get("data")
+    return d if isinstance(d, dict) else None
+
+def _env_payload(j):
+    d = j.get("payload")
+    return d if isinstance(d, dict) else None
+
+def _env_payload_str(j):
+    d = j.get("payload")
+    if not isinstance(d, str):
+        return None
+    try:
+        d = _json_loads(d)
+    except:
+        return None
+    return d if isinstance(d, dict) else None
+
+def _env_flat(j):
+    return j
+
+_TS_KEYS = [k.lower() for k in MQTT_TS_KEYS]
+
+def _find_ts_key(d):
+    # raw key timestamp sesuai urutan prioritas MQTT_TS_KEYS, atau None
+    found = {}
+    for rk in d:
+        k = str(rk).lower()
+        if k in _TS_KEYS and k not in found:
+            found[k] = rk
+    for k in _TS_KEYS:
+        if k in found:
+            return found[k]
+    return None
+
+def _num(v):
+    t = type(v)
+    if t is float:
+        return v
+    if t is int:
+        return float(v)
+    if t is str:
+        return float(v.strip().replace(",", "."))
+    return float(v)
+
+def _parse_device_ts(v):
+    # epoch detik / milidetik / mikrodetik (angka atau string angka) atau ISO 8601 -> epoch detik (float)
+    if isinstance(v, bool):
+        return None
+    if isinstance(v, str):
+        s = v.strip()
+        try:
+            v = float(s)
+        except ValueError:
+            if s[-1:] in ("Z", "z"):
+                s = s[:-1] + "+00:00"
+            try:
+                return datetime.fromisoformat(s).timestamp()   # tanpa zona = waktu lokal server
+            except ValueError:
+                return None
+    try:
+        v = float(v)
+    except (TypeError, ValueError):
+        return None
+    if v > 1e14:
+        return v / 1e6
+    if v > 1e11:
+        return v / 1e3
+    return v
+
+class PayloadDecoder:
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.key_set = set(self.keys)
+        # urutan = prioritas (sama dengan urutan cek lama); schema baru via register_envelope
+        self.envelopes = [("data", _env_data), ("payload", _env_payload),
+                          ("payload_str", _env_payload_str), ("flat", _env_flat)]
+        self.env = None        # (nama, fn) yang dipelajari
+        self.outer = None      # set key level atas saat envelope dipelajari
+        self.keyset = None     # set key raw saat plan disusun
+        self.plan = ()         # ((raw_key, KEY), ...) urut NUMERIC_KEYS
+        self.ts_inner = None   # raw key timestamp di dict data (dipelajari bersama plan)
+        self.ts_outer = None   # raw key timestamp di envelope luar
+        self.stats = {"decoded": 0, "relearn": 0, "fallback_text": 0, "device_ts": 0, "ts_invalid": 0}
+
+    def register_envelope(self, name, fn, first=True):
+        # fn(dict json) -> dict data atau None kalau bukan bentuknya
+        if first:
+            self.envelopes.insert(0, (name, fn))
+        else:
+            self.envelopes.insert(len(self.envelopes) - 1, (name, fn))
+        self.env = None
+
+    def _loads(self, payload):
+        try:
+            return _json_loads(payload)
+        except Exception:
+            # jalur lama: bytes rusak diabaikan lalu parse teks
+            self.stats["fallback_text"] += 1
+            text = payload.decode(errors="ignore").strip() if isinstance(payload, (bytes, bytearray)) else str(payload).strip()
+            if not text:
+                return None
+            return json.loads(text)
+
+    def _learn(self, j):
+        for env in self.envelopes:
+            raw = env[1](j)
+            if raw is not None:
+                self.env = env
+                self.outer = set(j.keys())
+                self.ts_outer = _find_ts_key(j) if raw is not j else None
+                self.stats["relearn"] += 1
+                return raw
+        return None
+
+    def _compile(self, raw):
+        found = {}
+        for rk in raw:
+            k = str(rk).upper()
+            if k in self.key_set:
+                found[k] = rk   # key kembar beda huruf: yang terakhir menang (sama seperti dulu)
+        self.plan = tuple((found[k], k) for k in self.keys if k in found)
+        self.ts_inner = _find_ts_key(raw)
+        self.keyset = set(raw.keys())
+
+    def decode(self, payload):
+        # -> {NUMERIC_KEY: float} hanya untuk key yang berhasil dibaca, atau None
+        return self.decode_ts(payload)[0]
+
+    def decode_ts(self, payload):
+        # -> (nilai seperti decode(), epoch detik dari device atau None)
+        j = self._loads(payload)
+        if not isinstance(j, dict):
+            return None, None
+
+        # set key luar sama -> envelope sama (prioritas cek lama tetap berlaku)
+        raw = self.env[1](j) if self.env is not None and j.keys() == self.outer else None
+        if raw is None:
+            raw = self._learn(j)
+            if not isinstance(raw, dict):
+                return None, None
+
+        if raw.keys() != self.keyset:
+            self._compile(raw)
+
+        out = {}
+        for rk, k in self.plan:
+            try:
+                out[k] = _num(raw[rk])
+            except:
+                pass
+        self.stats["decoded"] += 1
+
+        ts = None
+        if self.ts_inner is not None:
+            ts = _parse_device_ts(raw[self.ts_inner])
+        elif self.ts_outer is not None:
+            ts = _parse_device_ts(j[self.ts_outer])
+        if ts is not None:
+            self.stats["device_ts"] += 1
+        elif self.ts_inner is not None or self.ts_outer is not None:
+            self.stats["ts_invalid"] += 1
+        return out, ts
+
 # ================== MQTT ==================
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("Connected to MQTT broker")
-        client.subscribe(TOPIC, qos=0)
-        client.subscribe(TOPIC + "/#", qos=0)
+        for flt, _ in MQTT_TOPICS:
+            client.subscribe(flt, qos=0)
     else:
         print("Failed to connect to MQTT, code:", rc)
 
-def on_message(client, userdata, msg):
-    global last_send_time, latest_ts_epoch
-    try:
-        payload_text = msg.payload.decode(errors="ignore").strip()
-        if not payload_text:
-            return
-
-        raw = json.loads(payload_text)
-
-        if isinstance(raw, dict):
-            if "data" in raw and isinstance(raw["data"], dict):
-                raw = raw["data"]
-            elif "payload" in raw and isinstance(raw["payload"], dict):
-                raw = raw["payload"]
-            elif "payload" in raw and isinstance(raw["payload"], str):
+def site_for_topic(topic):
+    # filter pertama yang cocok menang; "$N" = segmen topic ke-N
+    for flt, site in MQTT_TOPICS:
+        if mqtt.topic_matches_sub(flt, topic):
+            if site.startswith("$"):
+                parts = topic.split("/")
                 try:
-                    j2 = json.loads(raw["payload"])
-                    if isinstance(j2, dict):
-                        raw = j2
-                except:
-                    pass
-
-        if not isinstance(raw, dict):
+                    return parts[int(site[1:])] or DEFAULT_SITE
+                except (ValueError, IndexError):
+                    return DEFAULT_SITE
+            return site
+    return DEFAULT_SITE
+
+def _sample_ts(dev_ts, recv_ts):
+    # ts device kalau jamnya masuk akal, selain itu waktu terima; dibulatkan ke ms
+    if dev_ts is not None and recv_ts - MQTT_TS_MAX_AGE <= dev_ts <= recv_ts + MQTT_TS_MAX_FUTURE:
+        return round(dev_ts, 3), True
+    return round(recv_ts, 3), False
+
+def process_mqtt_message(decoder, site, payload, recv_ts):
+    try:
+        values, dev_ts = decoder.decode_ts(payload)
+        if not values:
             return
-
-        raw_u = {str(k).upper(): v for k, v in raw.items()}
+        ts, from_device = _sample_ts(dev_ts, recv_ts)
+        if dev_ts is not None and not from_device:
+            decoder.stats["ts_invalid"] += 1
 
         with data_lock:
-            prev = dict(latest_data)
-
-        data = {}
-        matched = 0
-
-        for key in NUMERIC_KEYS:
-            if key in raw_u:
-                v = raw_u.get(key)
-                try:
-                    if isinstance(v, str):
-                        v = v.strip().replace(",", ".")
-                    data[key] = float(v)
-                    matched += 1
-                except:
-                    data[key] = float(prev.get(key, 0.0))
+            st = get_site_state(site)
+            prev = st.data
+            late = ts < st.ts
+            if late:
+                # replay / out-of-order: hanya key yang ada di pesan, state terbaru tidak disentuh
+                data = dict(values)
+                if "TOTAL_FLOW_ITK" in data and "TOTAL_FLOW_DST" in data:
+                    data["SELISIH_FLOW"] = data["TOTAL_FLOW_ITK"] - data["TOTAL_FLOW_DST"]
+                forward = False
             else:
-                data[key] = float(prev.get(key, 0.0))
-
-        if matched == 0:
+                if len(values) == len(NUMERIC_KEYS):
+                    data = values
+                else:
+                    # key yang tidak ada / gagal dibaca -> pakai nilai terakhir site ini
+                    data = {k: values[k] if k in values else float(prev.get(k, 0.0)) for k in NUMERIC_KEYS}
+                data["SELISIH_FLOW"] = data["TOTAL_FLOW_ITK"] - data["TOTAL_FLOW_DST"]
+
+                prev.update(data)
+                st.ts = ts
+                now = time.time()
+                forward = now - st.last_send >= SEND_INTERVAL
+                if forward:
+                    st.last_send = now
+
+            # hot cache & rollup tetap resolusi penuh; tabel raw hanya nilai yang berubah (sampel terlambat tidak dikompresi)
+            row = (ts, data, None)
+            if COMPRESS_KEYS and not late:
+                if st.comp is None:
+                    st.comp = SampleCompressor()
+                row = st.comp.push(ts, data)
+
+        hot_cache_add(site, ts, data)
+        if row is not None:
+            save_to_db(site, *row)
+        if late:
             return
+        event_hub.publish("qty", {"site": site, "ts": int(ts), "data": data}, channel=site)
 
-        data["SELISIH_FLOW"] = float(data.get("TOTAL_FLOW_ITK", 0.0)) - float(data.get("TOTAL_FLOW_DST", 0.0))
+        if forward:
+            # payload site default tetap sama seperti dulu; site lain diberi field "site"
+            webhook_forwarder.submit(int(ts), data if site == DEFAULT_SITE else dict(data, site=site))
 
-        with data_lock:
-            latest_data.clear()
-            latest_data.update(data)
-            latest_ts_epoch = int(time.time())
-
-        save_to_db(latest_ts_epoch, data)
+    except Exception as e:
+        print("MQTT processing error:", e)
 
-        now = time.time()
-        if now - last_send_time >= SEND_INTERVAL:
+class MqttPipeline:
+    # antrean per worker; worker dipilih dari hash(topic) supaya urutan per topic terjaga
+    def __init__(self, n_workers, queue_max):
+        self.n = max(1, n_workers)
+        self.queues = [queue.Queue(maxsize=queue_max) for _ in range(self.n)]
+        self.topics = {}     # topic -> (PayloadDecoder, site) (hanya disentuh worker topic tsb)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stats = [{"received": 0, "processed": 0, "dropped": 0,
+                       "lag_last": 0.0, "lag_max": 0.0, "lag_avg": 0.0, "proc_avg": 0.0}
+                      for _ in range(self.n)]
+
+    def start(self):
+        if self.threads:
+            return
+        for i in range(self.n):
+            t = threading.Thread(target=self._run, args=(i,), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, topic, payload, recv_ts):
+        # dari thread network paho: tidak pernah blok
+        i = hash(topic) % self.n
+        st = self.stats[i]
+        try:
+            self.queues[i].put_nowait((topic, payload, recv_ts))
+            st["received"] += 1
+        except queue.Full:
+            st["dropped"] += 1
+
+    def _topic_ctx(self, topic):
+        ctx = self.topics.get(topic)
+        if ctx is None:
+            ctx = self.topics[topic] = (PayloadDecoder(NUMERIC_KEYS), site_for_topic(topic))
+        return ctx
+
+    def _run(self, i):
+        q = self.queues[i]
+        st = self.stats[i]
+        next_idle = time.time() + COMPRESS_HEARTBEAT
+        while True:
+            if COMPRESS_KEYS and time.time() >= next_idle:
+                next_idle = time.time() + COMPRESS_HEARTBEAT
+                _compress_flush_idle(time.time())
             try:
-                requests.post(
-                    WEB_APP_URL,
-                    headers={"Content-Type": "application/json"},
-                    data=json.dumps(data),
-                    timeout=10
-                )
-            except Exception as e:
-                print("HTTP post error:", e)
-            last_send_time = now
+                topic, payload, recv_ts = q.get(timeout=COMPRESS_HEARTBEAT)
+            except queue.Empty:
+                continue
+            t0 = time.time()
+            lag = t0 - recv_ts
+            decoder, site = self._topic_ctx(topic)
+            process_mqtt_message(decoder, site, payload, recv_ts)
+            dt = time.time() - t0
+
+            with self.lock:
+                st["processed"] += 1
+                st["lag_last"] = lag
+                st["lag_max"] = max(st["lag_max"], lag)
+                # rata-rata bergerak (EWMA) supaya angka baru lebih berbobot
+                st["lag_avg"] += (lag - st["lag_avg"]) * 0.05
+                st["proc_avg"] += (dt - st["proc_avg"]) * 0.05
+
+    def snapshot_stats(self):
+        with self.lock:
+            workers = [dict(st, queue_depth=self.queues[i].qsize()) for i, st in enumerate(self.stats)]
+        return {
+            "workers": workers,
+            "queue_depth": sum(w["queue_depth"] for w in workers),
+            "queue_max": MQTT_WORKER_QUEUE_MAX,
+            "received": sum(w["received"] for w in workers),
+            "processed": sum(w["processed"] for w in workers),
+            "dropped": sum(w["dropped"] for w in workers),
+            "lag_max": max(w["lag_max"] for w in workers),
+            "topics": {t: dict(d.stats, site=site, backend=_JSON_BACKEND, envelope=d.env[0] if d.env else None)
+                       for t, (d, site) in list(self.topics.items())},
+        }
 
-    except Exception as e:
-        print("MQTT processing error:", e)
+mqtt_pipeline = MqttPipeline(MQTT_WORKERS, MQTT_WORKER_QUEUE_MAX)
+
+def on_message(client, userdata, msg):
+    mqtt_pipeline.submit(msg.topic, msg.payload, time.time())
 
 def mqtt_thread():
     client = mqtt.Client()
@@ -2354,14 +5075,200 @@ def mqtt_thread():
     client.connect(BROKER, PORT, 60)
     client.loop_forever()
 
+# ================== ASGI ==================
+# SSE di mode ASGI = coroutine (tidak memegang thread); route lain tetap Flask, dijalankan di executor
+class AsyncSubscriber:
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def _put(self, data):
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(data)
+
+    def put_nowait(self, data):
+        # dipanggil dari thread publisher
+        try:
+            self.loop.call_soon_threadsafe(self._put, data)
+        except RuntimeError:
+            pass  # event loop sudah ditutup
+
+    def get_nowait(self):
+        raise queue.Empty
+
+def _asgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] if server[1] is not None else 80),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = "HTTP_" + name
+        environ[key] = (environ[key] + "," + value) if key in environ else value
+    return environ
+
+def _run_wsgi(environ):
+    status_headers = []
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        status_headers[:] = [status, headers]
+        return chunks.append
+
+    it = app(environ, start_response)
+    try:
+        for c in it:
+            chunks.append(c)
+    finally:
+        if hasattr(it, "close"):
+            it.close()
+    return status_headers[0], status_headers[1], b"".join(chunks)
+
+async def _asgi_flask(scope, receive, send):
+    body = b""
+    more = True
+    while more:
+        msg = await receive()
+        body += msg.get("body", b"")
+        more = msg.get("more_body", False)
+
+    loop = asyncio.get_running_loop()
+    status, headers, out = await loop.run_in_executor(None, _run_wsgi, _asgi_environ(scope, body))
+    await send({
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": out})
+
+async def _asgi_events(scope, receive, send):
+    # habiskan body request dulu; receive() berikutnya baru http.disconnect
+    more = True
+    while more:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            return
+        more = msg.get("more_body", False)
+
+    qs = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    site = (qs.get("site", [""])[0]).strip() or DEFAULT_SITE
+
+    loop = asyncio.get_running_loop()
+    sub = AsyncSubscriber(loop, SSE_CLIENT_QUEUE)
+    event_hub.subscribe(sub, channel=site)
+    disconnect = asyncio.ensure_future(receive())
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-store, no-cache, must-revalidate, max-age=0"),
+                (b"pragma", b"no-cache"),
+                (b"expires", b"0"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        first = _first_event(site)
+        await send({"type": "http.response.body", "body": f"data: {json.dumps(first)}\n\n".encode(), "more_body": True})
+
+        while True:
+            getter = asyncio.ensure_future(sub.queue.get())
+            done, _ = await asyncio.wait({getter, disconnect}, timeout=SSE_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+            if disconnect in done:
+                getter.cancel()
+                break
+            if getter in done:
+                data = getter.result()
+            else:
+                getter.cancel()
+                data = b": ping\n\n"
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+    except OSError:
+        pass
+    finally:
+        event_hub.unsubscribe(sub)
+        disconnect.cancel()
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        loop = asyncio.get_running_loop()
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                from concurrent.futures import ThreadPoolExecutor
+                loop.set_default_executor(ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_WORKERS))
+                await loop.run_in_executor(None, start_background_workers)
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                await loop.run_in_executor(None, shutdown_ingest)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    elif scope["type"] == "http":
+        if scope["path"] == "/events":
+            await _asgi_events(scope, receive, send)
+        else:
+            await _asgi_flask(scope, receive, send)
+
 # ================== MAIN ==================
-if __name__ == "__main__":
+def start_background_workers():
     init_db()
+    if _narrow_pending:
+        threading.Thread(target=migration_worker, daemon=True).start()
+    warm_hot_cache()
+    qc_load_from_db()
+    start_ingest_writer()
+    webhook_forwarder.start()
+    mqtt_pipeline.start()
+    threading.Thread(target=retention_worker, daemon=True).start()
     threading.Thread(target=mqtt_thread, daemon=True).start()
     threading.Thread(target=qc_worker, daemon=True).start()
     threading.Thread(target=schedule_worker, daemon=True).start()
 
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-wide":
+        # migrasi offline: python app.py migrate-wide  (sekalian VACUUM biar file mengecil)
+        DB_STORAGE_MODE = "wide"
+        init_db()
+        migrate_narrow_to_wide(vacuum=True)
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "vacuum":
+        # konversi sekali history.db lama ke auto_vacuum=incremental: python app.py vacuum
+        init_db()
+        vacuum_incremental()
+        sys.exit(0)
+
     port = int(os.environ.get("PORT", "8000"))
-    app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
 
+    if len(sys.argv) > 1 and sys.argv[1] == "asgi":
+        # 1 proses, SSE sebagai coroutine: python app.py asgi
+        import uvicorn
+        uvicorn.run(asgi_app, host="0.0.0.0", port=port, lifespan="on", log_level="warning")
+        sys.exit(0)
 
+    start_background_workers()
+    app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
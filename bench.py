@@ -0,0 +1,252 @@
+# Benchmark kecil untuk jalur panas app.py (jalankan manual, bukan bagian dari server)
+#   python bench.py qc-parse [--rows 100000]
+#   python bench.py memory [--schedule jadwal_2026.json] [--qc-rows 200000]
+#   python bench.py decode [--file payloads.jsonl] [--n 200000]
+import argparse
+import csv
+import gc
+import io
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import app
+
+def _synthetic_qc_csv(n_rows, seed=1):
+    rnd = random.Random(seed)
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(["Timestamp", "DateTime", "Kekeruhan", "Warna", "pH", "Sisa Chlor", "Petugas"])
+    t = datetime(2020, 1, 1)
+    for i in range(n_rows):
+        # ~4 baris per jam, sebagian dengan menit yang sama (string timestamp berulang)
+        t += timedelta(minutes=rnd.choice([0, 15, 15, 30]))
+        chl = "" if i % 3 else f"{rnd.uniform(0.2, 1.2):.2f}".replace(".", ",")
+        w.writerow([
+            t.strftime("%d/%m/%Y %H:%M:%S"),
+            t.strftime("%Y-%m-%d %H:%M"),
+            f"{rnd.uniform(0.5, 5):.2f}",
+            str(rnd.randint(1, 15)),
+            f"{rnd.uniform(6.5, 8.5):.2f}",
+            chl,
+            "analis",
+        ])
+    return out.getvalue()
+
+def _legacy_parse_rows(text):
+    # salinan jalur lama: strptime per format per baris + _to_float versi string
+    reader = csv.DictReader(io.StringIO(text))
+    cols = app._qc_columns(reader.fieldnames or [])
+    rows = []
+    for row in reader:
+        dt_obj = app._parse_dt(row.get(cols["dt"]) if cols["dt"] else None)
+        if not dt_obj:
+            continue
+        rr = {"ts": int(dt_obj.timestamp()), "dt": dt_obj.strftime("%Y-%m-%d %H:%M")}
+        for p in app.QC_ORDER:
+            c = cols[p]
+            v = row.get(c) if c else None
+            rr[p] = app._to_float_text(v) if v is not None else None
+        rows.append(rr)
+    rows.sort(key=lambda x: x["ts"])
+    return rows
+
+def _fast_parse_rows(text):
+    reader = csv.reader(io.StringIO(text))
+    fieldnames = next(reader, None) or []
+    rows = app._qc_parse_rows(reader, fieldnames, app._qc_columns(fieldnames))
+    rows.sort(key=lambda x: x["ts"])
+    return rows
+
+def _best_of(fn, arg, repeat):
+    best = None
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(arg)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, out
+
+def bench_qc_parse(args):
+    text = _synthetic_qc_csv(args.rows)
+    t_old, rows_old = _best_of(_legacy_parse_rows, text, args.repeat)
+    t_new, rows_new = _best_of(_fast_parse_rows, text, args.repeat)
+    assert rows_old == rows_new, "hasil parse lama dan baru berbeda"
+
+    n = len(rows_new)
+    print(f"QC parse, {n} baris ({len(text) / 1e6:.1f} MB CSV)")
+    print(f"  sebelum : {t_old:8.3f} s  {n / t_old:12,.0f} baris/s")
+    print(f"  sesudah : {t_new:8.3f} s  {n / t_new:12,.0f} baris/s")
+    print(f"  speedup : {t_old / t_new:8.2f}x")
+
+def _retained(build):
+    # byte yang masih dialokasikan setelah build() (hasil ditahan sampai diukur)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return size, obj
+
+def _legacy_schedule_rows(path):
+    # salinan jalur lama: json.load + dict per baris
+    with open(path, "r", encoding="utf-8") as f:
+        rows = json.load(f)
+    return [{
+        "tanggal": r.get("tanggal"),
+        "nama": r.get("nama"),
+        "jabatan": r.get("jabatan"),
+        "shift_kode": r.get("shift_kode"),
+        "jam_kerja": r.get("jam_kerja"),
+        "lokasi": r.get("lokasi"),
+        "jam_mulai": r.get("jam_mulai"),
+        "jam_selesai": r.get("jam_selesai"),
+    } for r in rows if isinstance(r, dict)]
+
+def _compact_schedule_rows(path):
+    shared = {}
+    with open(path, "r", encoding="utf-8") as f:
+        return [app.ScheduleRow(r, shared) for r in app._iter_json_array(f) if isinstance(r, dict)]
+
+def _report(title, n, before, after):
+    print(title)
+    print(f"  sebelum : {before / 1e6:8.2f} MB  {before / n:8.1f} byte/baris")
+    print(f"  sesudah : {after / 1e6:8.2f} MB  {after / n:8.1f} byte/baris")
+    print(f"  hemat   : {before / after:8.2f}x")
+
+def bench_memory(args):
+    b, rows = _retained(lambda: _legacy_schedule_rows(args.schedule))
+    del rows
+    a, rows = _retained(lambda: _compact_schedule_rows(args.schedule))
+    _report(f"Jadwal {args.schedule}, {len(rows)} baris (list of dict vs ScheduleRow)", len(rows), b, a)
+    del rows
+
+    text = _synthetic_qc_csv(args.qc_rows)
+    # "sebelum" = qc_rows lama (list of dict); "sesudah" = QCSeries kolumnar
+    b, rows = _retained(lambda: _fast_parse_rows(text))
+    a, series = _retained(lambda: app.QCSeries(rows))
+    print()
+    _report(f"QC sintetis, {len(series)} baris (list of dict vs QCSeries)", len(series), b, a)
+
+def _synthetic_payloads(n, seed=1):
+    # bentuk payload gateway: envelope "data", key huruf kecil, sebagian angka string koma
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        vals = {k.lower(): round(rnd.uniform(0, 500), 3) for k in app.NUMERIC_KEYS}
+        vals["FLOW_CIJERUK"] = f"{rnd.uniform(0, 50):.2f}".replace(".", ",")
+        vals["rssi"] = -rnd.randint(40, 90)
+        out.append(json.dumps({"device": "gw-1", "ts": 1700000000 + i, "data": vals}).encode())
+    return out
+
+def _legacy_decode(payload, prev):
+    # salinan jalur lama on_message (sampai dict data)
+    payload_text = payload.decode(errors="ignore").strip()
+    if not payload_text:
+        return None
+    raw = json.loads(payload_text)
+    if isinstance(raw, dict):
+        if "data" in raw and isinstance(raw["data"], dict):
+            raw = raw["data"]
+        elif "payload" in raw and isinstance(raw["payload"], dict):
+            raw = raw["payload"]
+        elif "payload" in raw and isinstance(raw["payload"], str):
+            try:
+                j2 = json.loads(raw["payload"])
+                if isinstance(j2, dict):
+                    raw = j2
+            except:
+                pass
+    if not isinstance(raw, dict):
+        return None
+    raw_u = {str(k).upper(): v for k, v in raw.items()}
+    prev = dict(prev)
+    data = {}
+    matched = 0
+    for key in app.NUMERIC_KEYS:
+        if key in raw_u:
+            v = raw_u.get(key)
+            try:
+                if isinstance(v, str):
+                    v = v.strip().replace(",", ".")
+                data[key] = float(v)
+                matched += 1
+            except:
+                data[key] = float(prev.get(key, 0.0))
+        else:
+            data[key] = float(prev.get(key, 0.0))
+    if matched == 0:
+        return None
+    return data
+
+def _legacy_decode_all(payloads):
+    prev = dict(app.DEFAULT_DATA)
+    out = []
+    for p in payloads:
+        d = _legacy_decode(p, prev)
+        if d:
+            prev.update(d)
+        out.append(d)
+    return out
+
+def _fast_decode_all(payloads):
+    dec = app.PayloadDecoder(app.NUMERIC_KEYS)
+    prev = dict(app.DEFAULT_DATA)
+    out = []
+    for p in payloads:
+        v = dec.decode(p)
+        if not v:
+            out.append(None)
+            continue
+        d = v if len(v) == len(app.NUMERIC_KEYS) else {k: v[k] if k in v else prev[k] for k in app.NUMERIC_KEYS}
+        prev.update(d)
+        out.append(d)
+    return out
+
+def bench_decode(args):
+    if args.file:
+        with open(args.file, "rb") as f:
+            payloads = [line.rstrip(b"\n") for line in f if line.strip()]
+    else:
+        payloads = _synthetic_payloads(args.n)
+
+    t_old, out_old = _best_of(_legacy_decode_all, payloads, args.repeat)
+    t_new, out_new = _best_of(_fast_decode_all, payloads, args.repeat)
+    assert repr(out_old) == repr(out_new), "hasil decode lama dan baru berbeda"   # repr: NaN != NaN
+
+    n = len(payloads)
+    print(f"Decode payload MQTT, {n} pesan (backend JSON: {app._JSON_BACKEND})")
+    print(f"  sebelum : {t_old:8.3f} s  {n / t_old:12,.0f} pesan/s")
+    print(f"  sesudah : {t_new:8.3f} s  {n / t_new:12,.0f} pesan/s")
+    print(f"  speedup : {t_old / t_new:8.2f}x")
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark Dashboard_IOT")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("qc-parse", help="parse CSV QC: jalur lama vs QCDateParser + csv.reader")
+    p.add_argument("--rows", type=int, default=100000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_qc_parse)
+
+    p = sub.add_parser("memory", help="footprint per baris: jadwal & QC, representasi lama vs ringkas")
+    p.add_argument("--schedule", default=app.SCHEDULE_JSON_FILE)
+    p.add_argument("--qc-rows", type=int, default=200000)
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("decode", help="decode payload MQTT: jalur lama vs PayloadDecoder")
+    p.add_argument("--file", help="jsonl rekaman payload (1 pesan per baris); default sintetis")
+    p.add_argument("--n", type=int, default=200000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_decode)
+
+    args = ap.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()